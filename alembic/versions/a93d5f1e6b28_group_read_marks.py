@@ -0,0 +1,89 @@
+"""replace per-message group_message_reads with per-member group_read_marks
+
+Revision ID: a93d5f1e6b28
+Revises: f2b6e8a4c913
+Create Date: 2025-08-29 16:40:12.558913
+
+Each member's read rows collapse into one watermark: the newest message they had read. Group
+unread counts in chat_summaries are recomputed from the watermarks.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a93d5f1e6b28'
+down_revision: Union[str, None] = 'f2b6e8a4c913'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+RECOUNT_GROUP_UNREAD = """
+UPDATE chat_summaries SET unread_count = (
+    SELECT count(*) FROM group_messages gm
+    WHERE gm.group_id = chat_summaries.chat_id AND gm.sender_id != chat_summaries.user_id
+      AND gm.id > coalesce((SELECT m.last_read_message_id FROM group_read_marks m
+                            WHERE m.group_id = chat_summaries.chat_id AND m.user_id = chat_summaries.user_id), 0)
+) WHERE chat_type = 'group'
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'group_read_marks',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('group_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('last_read_message_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('group_id', 'user_id', name='unique_group_read_mark'),
+        if_not_exists=True,
+    )
+    op.create_index(op.f('ix_group_read_marks_id'), 'group_read_marks', ['id'], unique=False, if_not_exists=True)
+    op.create_index('ix_group_read_marks_group_last_read', 'group_read_marks', ['group_id', 'last_read_message_id'],
+                    unique=False, if_not_exists=True)
+
+    op.execute(sa.text("""
+        INSERT INTO group_read_marks (group_id, user_id, last_read_message_id)
+        SELECT gm.group_id, r.user_id, max(gm.id) FROM group_message_reads r
+            JOIN group_messages gm ON gm.id = r.group_message_id
+            WHERE r.is_read = 1 AND r.user_id IS NOT NULL
+            GROUP BY gm.group_id, r.user_id
+        ON CONFLICT (group_id, user_id) DO UPDATE
+            SET last_read_message_id = max(last_read_message_id, excluded.last_read_message_id)
+    """))
+    op.execute(sa.text(RECOUNT_GROUP_UNREAD))
+
+    op.drop_index(op.f('ix_group_message_reads_id'), table_name='group_message_reads', if_exists=True)
+    op.drop_table('group_message_reads')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_table(
+        'group_message_reads',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('group_message_id', sa.Integer(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('is_read', sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(['group_message_id'], ['group_messages.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('group_message_id', 'user_id', name='unique_group_message_read'),
+    )
+    op.create_index(op.f('ix_group_message_reads_id'), 'group_message_reads', ['id'], unique=False)
+    # A read row for every message from someone else up to the member's watermark
+    op.execute(sa.text("""
+        INSERT INTO group_message_reads (group_message_id, user_id, is_read)
+        SELECT gm.id, m.user_id, 1 FROM group_read_marks m
+            JOIN group_messages gm ON gm.group_id = m.group_id AND gm.id <= m.last_read_message_id
+            WHERE gm.sender_id != m.user_id
+    """))
+
+    op.drop_index('ix_group_read_marks_group_last_read', table_name='group_read_marks', if_exists=True)
+    op.drop_index(op.f('ix_group_read_marks_id'), table_name='group_read_marks', if_exists=True)
+    op.drop_table('group_read_marks')
@@ -0,0 +1,47 @@
+"""add user_sessions, the server-side logins behind refresh tokens
+
+Revision ID: b7e2c4f91d36
+Revises: a93d5f1e6b28
+Create Date: 2025-09-02 10:14:37.902215
+
+Tokens issued before this revision carry no session id and stay valid until they expire.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2c4f91d36'
+down_revision: Union[str, None] = 'a93d5f1e6b28'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'user_sessions',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('refresh_token_hash', sa.String(), nullable=False),
+        sa.Column('previous_token_hash', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('last_used_at', sa.DateTime(), nullable=True),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.Column('revoked_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        if_not_exists=True,
+    )
+    op.create_index(op.f('ix_user_sessions_id'), 'user_sessions', ['id'], unique=False, if_not_exists=True)
+    op.create_index(op.f('ix_user_sessions_user_id'), 'user_sessions', ['user_id'], unique=False,
+                    if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_user_sessions_user_id'), table_name='user_sessions', if_exists=True)
+    op.drop_index(op.f('ix_user_sessions_id'), table_name='user_sessions', if_exists=True)
+    op.drop_table('user_sessions')
@@ -0,0 +1,44 @@
+"""add composite indexes for conversation, unread and group queries
+
+Revision ID: c4d2a7e91b53
+Revises: 70aa02ae9484
+Create Date: 2025-08-14 10:12:03.417250
+
+Databases created by Base.metadata.create_all() before this revision have no alembic_version
+table; run `alembic stamp 70aa02ae9484` once on those, then `alembic upgrade head`.
+Fresh databases already get these indexes from the models, hence if_not_exists.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4d2a7e91b53'
+down_revision: Union[str, None] = '70aa02ae9484'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_messages_sender_receiver_timestamp', 'messages', ['sender_id', 'receiver_id', 'timestamp']),
+    ('ix_messages_receiver_sender_is_read', 'messages', ['receiver_id', 'sender_id', 'is_read']),
+    ('ix_group_messages_group_timestamp', 'group_messages', ['group_id', 'timestamp']),
+    ('ix_user_group_group_user', 'user_group', ['group_id', 'user_id']),
+    ('ix_user_group_user_group', 'user_group', ['user_id', 'group_id']),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False, if_not_exists=True)
+    # Give the planner row counts for the new indexes
+    op.execute(sa.text('ANALYZE'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
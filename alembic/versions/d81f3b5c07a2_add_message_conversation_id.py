@@ -0,0 +1,37 @@
+"""add canonical conversation_id to direct messages
+
+Revision ID: d81f3b5c07a2
+Revises: c4d2a7e91b53
+Create Date: 2025-08-18 09:41:27.203118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd81f3b5c07a2'
+down_revision: Union[str, None] = 'c4d2a7e91b53'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('conversation_id', sa.String(), nullable=True))
+    # Same format as app.models.conversation_key: "<lower user id>:<higher user id>"
+    op.execute(sa.text(
+        "UPDATE messages SET conversation_id = "
+        "CAST(MIN(sender_id, receiver_id) AS TEXT) || ':' || CAST(MAX(sender_id, receiver_id) AS TEXT) "
+        "WHERE receiver_id IS NOT NULL AND conversation_id IS NULL"
+    ))
+    op.create_index('ix_messages_conversation_timestamp', 'messages', ['conversation_id', 'timestamp'],
+                    unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_conversation_timestamp', table_name='messages', if_exists=True)
+    op.drop_column('messages', 'conversation_id')
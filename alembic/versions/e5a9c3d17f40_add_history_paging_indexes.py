@@ -0,0 +1,37 @@
+"""add (conversation, id) indexes for keyset paging of message history
+
+Revision ID: e5a9c3d17f40
+Revises: d81f3b5c07a2
+Create Date: 2025-08-21 15:03:44.901372
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a9c3d17f40'
+down_revision: Union[str, None] = 'd81f3b5c07a2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_messages_conversation_id', 'messages', ['conversation_id', 'id']),
+    ('ix_group_messages_group_id', 'group_messages', ['group_id', 'id']),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False, if_not_exists=True)
+    op.execute(sa.text('ANALYZE'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
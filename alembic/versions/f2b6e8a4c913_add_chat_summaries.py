@@ -0,0 +1,116 @@
+"""add chat_summaries, the precomputed rows behind GET /chats
+
+Revision ID: f2b6e8a4c913
+Revises: e5a9c3d17f40
+Create Date: 2025-08-26 11:27:50.618204
+
+The app keeps the rows current from then on (app/chat_summaries.py). The backfill below
+rebuilds them from scratch, so it is also safe on a table create_all() already made.
+"""
+from collections import defaultdict
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2b6e8a4c913'
+down_revision: Union[str, None] = 'e5a9c3d17f40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _preview(content, file_path):
+    # Same text as app.chat_summaries.preview_text
+    if file_path:
+        file_name = file_path.split("/")[-1]
+        if content and content.strip():
+            return f"{file_name}: {content.strip()}"
+        return file_name
+    return content or ""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    summaries = op.create_table(
+        'chat_summaries',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('chat_type', sa.String(), nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.Column('last_message_id', sa.Integer(), nullable=True),
+        sa.Column('last_message', sa.Text(), nullable=True),
+        sa.Column('last_sender_id', sa.Integer(), nullable=True),
+        sa.Column('last_is_read', sa.Boolean(), nullable=True),
+        sa.Column('last_ts', sa.DateTime(), nullable=True),
+        sa.Column('unread_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'chat_type', 'chat_id', name='unique_chat_summary'),
+        if_not_exists=True,
+    )
+    op.create_index(op.f('ix_chat_summaries_id'), 'chat_summaries', ['id'], unique=False, if_not_exists=True)
+    op.create_index('ix_chat_summaries_user_last_ts', 'chat_summaries', ['user_id', 'last_ts'], unique=False,
+                    if_not_exists=True)
+    op.create_index('ix_chat_summaries_chat', 'chat_summaries', ['chat_type', 'chat_id'], unique=False,
+                    if_not_exists=True)
+
+    bind = op.get_bind()
+    bind.execute(sa.text('DELETE FROM chat_summaries'))
+    rows = {}
+
+    # Direct chats: a row for each side, last message by id, unread = unread messages from the peer
+    unread = defaultdict(int)
+    for receiver_id, sender_id, count in bind.execute(sa.text(
+        "SELECT receiver_id, sender_id, count(*) FROM messages "
+        "WHERE receiver_id IS NOT NULL AND is_read = 0 GROUP BY receiver_id, sender_id"
+    )):
+        unread[(receiver_id, sender_id)] = count
+    for m in bind.execute(sa.text(
+        "SELECT id, sender_id, receiver_id, content, file_path, is_read, timestamp FROM messages "
+        "WHERE id IN (SELECT max(id) FROM messages WHERE receiver_id IS NOT NULL GROUP BY conversation_id)"
+    )):
+        for user_id, peer_id in {(m.sender_id, m.receiver_id), (m.receiver_id, m.sender_id)}:
+            rows[(user_id, 'direct', peer_id)] = dict(
+                user_id=user_id, chat_type='direct', chat_id=peer_id, last_message_id=m.id,
+                last_message=_preview(m.content, m.file_path), last_sender_id=m.sender_id,
+                last_is_read=bool(m.is_read), last_ts=m.timestamp, unread_count=unread[(user_id, peer_id)],
+            )
+
+    # Groups: a row per member, even for groups without messages
+    last = {g.group_id: g for g in bind.execute(sa.text(
+        "SELECT id, group_id, sender_id, content, file_path, timestamp FROM group_messages "
+        "WHERE id IN (SELECT max(id) FROM group_messages GROUP BY group_id)"
+    ))}
+    unread = defaultdict(int)
+    for user_id, group_id, count in bind.execute(sa.text(
+        "SELECT ug.user_id, gm.group_id, count(*) "
+        "FROM (SELECT DISTINCT user_id, group_id FROM user_group) ug "
+        "JOIN group_messages gm ON gm.group_id = ug.group_id AND gm.sender_id != ug.user_id "
+        "LEFT JOIN group_message_reads r ON r.group_message_id = gm.id AND r.user_id = ug.user_id AND r.is_read = 1 "
+        "WHERE r.id IS NULL GROUP BY ug.user_id, gm.group_id"
+    )):
+        unread[(user_id, group_id)] = count
+    for user_id, group_id in bind.execute(sa.text("SELECT DISTINCT user_id, group_id FROM user_group")):
+        g = last.get(group_id)
+        rows[(user_id, 'group', group_id)] = dict(
+            user_id=user_id, chat_type='group', chat_id=group_id,
+            last_message_id=g.id if g else None,
+            last_message=_preview(g.content, g.file_path) if g else None,
+            last_sender_id=g.sender_id if g else None, last_is_read=None,
+            last_ts=g.timestamp if g else None, unread_count=unread[(user_id, group_id)],
+        )
+
+    if rows:
+        # Timestamps are copied as stored, so write through a string-typed table
+        raw = sa.table('chat_summaries', *(sa.column(c.name) for c in summaries.columns if c.name != 'id'))
+        bind.execute(raw.insert(), list(rows.values()))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_summaries_chat', table_name='chat_summaries', if_exists=True)
+    op.drop_index('ix_chat_summaries_user_last_ts', table_name='chat_summaries', if_exists=True)
+    op.drop_index(op.f('ix_chat_summaries_id'), table_name='chat_summaries', if_exists=True)
+    op.drop_table('chat_summaries')
@@ -1,9 +1,108 @@
+# In auth.py
+#
+# Password and security-answer hashing. bcrypt is deliberately slow (~250 ms a call), so it never
+# runs on the event loop, nor unbounded in the request threadpool: every hash and verify goes
+# through hash_pool, a few dedicated threads (bcrypt releases the GIL) that cap how many run at
+# once and queue the rest. Hashes made with an older cost factor are replaced at the next login.
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt cost factor for new hashes; raising it upgrades existing users as they log in
+BCRYPT_ROUNDS = 12
+# Hashes running at once. Leaves cores for the event loop and the DB thread.
+HASH_THREADS = max(2, min(4, (os.cpu_count() or 2) - 1))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+
+class HashPool:
+    """Bounded thread pool for bcrypt, with queueing metrics."""
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="hash")
+        self._lock = threading.Lock()
+        # Counters
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.work_seconds = 0.0
+
+    def _timed(self, submitted: float, fn, *args):
+        started = time.perf_counter()
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_seconds += started - submitted
+            self.max_wait_seconds = max(self.max_wait_seconds, started - submitted)
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                self.work_seconds += time.perf_counter() - started
+
+    def submit(self, fn, *args) -> Future:
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        return self._executor.submit(self._timed, time.perf_counter(), fn, *args)
+
+    def run(self, fn, *args):
+        """Blocking call, for sync routes (which already run in the request threadpool)."""
+        return self.submit(fn, *args).result()
+
+    async def run_async(self, fn, *args):
+        """Await fn(*args) on the pool without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def stats(self) -> Dict:
+        return {
+            "threads": self.threads,
+            "bcrypt_rounds": BCRYPT_ROUNDS,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "max_queued": self.max_queued,
+            "avg_wait_ms": round(self.wait_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+            "avg_hash_ms": round(self.work_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+        }
+
+
+hash_pool = HashPool(HASH_THREADS)
+
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return hash_pool.run(pwd_context.hash, password)
+
+def hash_passwords(secrets: List[str]) -> List[str]:
+    """Hash several secrets side by side on the pool."""
+    futures = [hash_pool.submit(pwd_context.hash, secret) for secret in secrets]
+    return [future.result() for future in futures]
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return hash_pool.run(pwd_context.verify, plain_password, hashed_password)
+
+def verify_passwords(pairs: List[Tuple[str, str]]) -> List[bool]:
+    """Verify several (plain, hashed) pairs side by side on the pool."""
+    futures = [hash_pool.submit(pwd_context.verify, plain, hashed) for plain, hashed in pairs]
+    return [future.result() for future in futures]
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Verify off the event loop. Also returns the hash to store instead when hashed_password was
+    made with an outdated cost factor (None otherwise).
+    """
+    return await hash_pool.run_async(pwd_context.verify_and_update, plain_password, hashed_password)
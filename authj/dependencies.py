@@ -2,6 +2,7 @@ from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from app.authj.jwt_handler import SECRET_KEY, ALGORITHM, decode_access_token
+from app.authj.principal_cache import principal_cache
 from app.models import User
 from app.database import SessionLocal
 from sqlalchemy.orm import Session
@@ -16,17 +17,22 @@ def get_db():
         db.close()
 
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    """
+    The caller as a detached User with only id and username loaded (see principal_cache);
+    query anything else through db.
+    """
     credentials_exception = HTTPException(
         status_code=401, detail="Could not validate credentials"
     )
-    payload = decode_access_token(token)
+    payload = principal_cache.decode(token)
     if payload is None:
         raise credentials_exception
     username: str = payload.get("sub")
     if username is None:
         raise credentials_exception
 
-    user = db.query(User).filter(User.username == username).first()
+    # Tokens from /login and /token/refresh name their session; it must not have been revoked
+    user = principal_cache.load_user(db, username, payload.get("sid"))
     if user is None:
         raise credentials_exception
     return user
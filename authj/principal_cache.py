@@ -0,0 +1,152 @@
+# In authj/principal_cache.py
+#
+# Bounded caches in front of get_current_user and the WebSocket handshake, so most authenticated
+# requests neither re-verify the JWT nor query the users table:
+#   - decoded token payloads, kept until the token expires (at most TOKEN_CACHE_SECONDS)
+#   - principals: just the user's id and username, for PRINCIPAL_TTL_SECONDS
+#   - login sessions (the access token's "sid") known to be active, for as long
+# Routes that change a user row call invalidate(username); revoking a session forgets it here.
+# Other workers keep their copy until the TTL runs out, which is why it is short.
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from app.authj.jwt_handler import decode_access_token
+from app.models import User, UserSession
+
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_SECONDS = 300
+PRINCIPAL_CACHE_SIZE = 10000
+PRINCIPAL_TTL_SECONDS = 60
+
+
+class TTLCache:
+    """LRU dict whose entries also expire. Thread-safe: sync dependencies run in the threadpool."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[object, tuple]" = OrderedDict()  # key -> (value, expires at)
+        self._lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def _principal(user_id: int, username: str) -> User:
+    """
+    A detached User carrying only id and username, a fresh instance per request. Anything else
+    (relationships, other columns) must be loaded through the request's own session;
+    db.merge() on it is safe because it holds no other, possibly stale, values.
+    """
+    user = User(id=user_id, username=username)
+    make_transient_to_detached(user)
+    return user
+
+
+def session_active(db: Session, session_id: int) -> bool:
+    """Whether the session behind an access token is neither revoked nor expired, from the DB."""
+    return db.query(UserSession.id).filter(
+        UserSession.id == session_id, UserSession.revoked_at.is_(None), UserSession.expires_at > datetime.utcnow()
+    ).scalar() is not None
+
+
+class PrincipalCache:
+    def __init__(self, token_size: int = TOKEN_CACHE_SIZE, principal_size: int = PRINCIPAL_CACHE_SIZE,
+                 token_seconds: float = TOKEN_CACHE_SECONDS, principal_ttl: float = PRINCIPAL_TTL_SECONDS):
+        self.tokens = TTLCache(token_size)
+        self.principals = TTLCache(principal_size)
+        self.sessions = TTLCache(principal_size)
+        self.token_seconds = token_seconds
+        self.principal_ttl = principal_ttl
+        self.invalidations = 0
+
+    def decode(self, token: str) -> Optional[Dict]:
+        """decode_access_token(), reusing the payload while the token is still valid."""
+        payload = self.tokens.get(token)
+        if payload is not None:
+            return payload
+        payload = decode_access_token(token)
+        if payload is not None:
+            ttl = min(self.token_seconds, payload.get("exp", 0) - time.time())
+            if ttl > 0:
+                self.tokens.put(token, payload, ttl)
+        return payload
+
+    def load_user(self, db: Session, username: str, session_id: Optional[int] = None) -> Optional[User]:
+        """
+        The user's principal, or None if there is no such user or the token's session (its "sid",
+        if it has one) has ended. Only active sessions are cached.
+        """
+        if session_id is not None and self.sessions.get(session_id) is None:
+            if not session_active(db, session_id):
+                return None
+            self.sessions.put(session_id, True, self.principal_ttl)
+        cached = self.principals.get(username)
+        if cached is None:
+            user_id = db.query(User.id).filter(User.username == username).scalar()
+            if user_id is None:
+                return None
+            self.principals.put(username, user_id, self.principal_ttl)
+            cached = user_id
+        return _principal(cached, username)
+
+    def invalidate(self, username: str):
+        """Forget the user's principal; call after changing their row."""
+        self.principals.pop(username)
+        self.invalidations += 1
+
+    def forget_sessions(self, session_ids: Iterable[int]):
+        """Drop revoked sessions, so their access tokens stop working on this worker at once."""
+        for session_id in session_ids:
+            self.sessions.pop(session_id)
+
+    def stats(self) -> Dict:
+        return {
+            "tokens": self.tokens.stats(),
+            "principals": self.principals.stats(),
+            "sessions": self.sessions.stats(),
+            "principal_ttl_seconds": self.principal_ttl,
+            "invalidations": self.invalidations,
+        }
+
+
+principal_cache = PrincipalCache()
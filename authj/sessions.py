@@ -0,0 +1,109 @@
+# In authj/sessions.py
+#
+# Server-side login sessions (user_sessions). /login opens one and hands out a refresh token
+# "<session id>.<secret>"; /token/refresh swaps it for a new access token and a new refresh token
+# with one UPDATE, no bcrypt. Only the secret's sha256 is stored.
+# A refresh token that was already rotated out coming back means it was copied: the session is
+# revoked, so neither the thief nor the client can keep using it. Logout and password changes
+# revoke sessions too; access tokens name theirs in the "sid" claim and stop working with it.
+# Every function commits its own transaction.
+
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from app.authj.principal_cache import principal_cache
+from app.models import User, UserSession
+
+REFRESH_TOKEN_DAYS = 30
+
+
+def _digest(secret: str) -> str:
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def _parse(refresh_token: str) -> Optional[Tuple[int, str]]:
+    session_id, _, secret = (refresh_token or "").partition(".")
+    if not session_id.isdigit() or not secret:
+        return None
+    return int(session_id), secret
+
+
+def open_session(db: Session, user_id: int) -> Tuple[int, str]:
+    """Start a session for the user: (session id, refresh token)."""
+    secret = secrets.token_urlsafe(32)
+    session = UserSession(user_id=user_id, refresh_token_hash=_digest(secret),
+                          expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_DAYS))
+    db.add(session)
+    db.flush()
+    session_id = session.id
+    db.commit()
+    return session_id, f"{session_id}.{secret}"
+
+
+def rotate_session(db: Session, refresh_token: str) -> Optional[Tuple[int, str, str]]:
+    """
+    Trade a refresh token for its successor: (session id, username, new refresh token), or None
+    if the token is unknown, expired, revoked or a replay of an old one.
+    """
+    parsed = _parse(refresh_token)
+    if parsed is None:
+        return None
+    session_id, secret = parsed
+    digest = _digest(secret)
+    new_secret = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    user_id = db.execute(
+        update(UserSession).where(
+            UserSession.id == session_id, UserSession.refresh_token_hash == digest,
+            UserSession.revoked_at.is_(None), UserSession.expires_at > now,
+        ).values(previous_token_hash=digest, refresh_token_hash=_digest(new_secret), last_used_at=now)
+        .returning(UserSession.user_id)
+    ).scalar()
+    if user_id is None:
+        reused = db.execute(
+            update(UserSession).where(
+                UserSession.id == session_id, UserSession.previous_token_hash == digest,
+                UserSession.revoked_at.is_(None),
+            ).values(revoked_at=now).returning(UserSession.id)
+        ).scalar()
+        db.commit()
+        if reused is not None:
+            print(f"Refresh token reuse on session {session_id}, session revoked")
+            principal_cache.forget_sessions([session_id])
+        return None
+    username = db.query(User.username).filter(User.id == user_id).scalar()
+    db.commit()
+    return session_id, username, f"{session_id}.{new_secret}"
+
+
+def revoke_session(db: Session, refresh_token: str, user_id: int) -> bool:
+    """End the user's session that refresh_token belongs to (logout)."""
+    parsed = _parse(refresh_token)
+    if parsed is None:
+        return False
+    session_id, secret = parsed
+    revoked = db.execute(
+        update(UserSession).where(
+            UserSession.id == session_id, UserSession.user_id == user_id,
+            UserSession.refresh_token_hash == _digest(secret), UserSession.revoked_at.is_(None),
+        ).values(revoked_at=datetime.utcnow()).returning(UserSession.id)
+    ).scalar()
+    db.commit()
+    principal_cache.forget_sessions([session_id])
+    return revoked is not None
+
+
+def revoke_user_sessions(db: Session, user_id: int) -> List[int]:
+    """End all of the user's sessions, e.g. after a password change. Returns their ids."""
+    revoked = db.execute(
+        update(UserSession).where(UserSession.user_id == user_id, UserSession.revoked_at.is_(None))
+        .values(revoked_at=datetime.utcnow()).returning(UserSession.id)
+    ).scalars().all()
+    db.commit()
+    principal_cache.forget_sessions(revoked)
+    return revoked
@@ -0,0 +1,279 @@
+# In backplane.py
+#
+# Routing events (deliveries, broadcasts, presence) travel through a backplane so that
+# several uvicorn worker processes can share one set of WebSocket users. Every
+# ConnectionManager publishes through the backplane and only ever writes to the
+# sockets it holds itself.
+#
+# The backplane also numbers critical deliveries: each recipient gets its own monotonic
+# "seq", handed out in one place (this process, or the broker) so every worker agrees on it.
+
+import asyncio
+import json
+import os
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Which backplane the module-level manager uses. Run a single worker with the default,
+# or point every worker at the same socket path, e.g.
+#   NETCONNECT_BACKPLANE=unix:///tmp/netconnect.sock uvicorn app.main:app --workers 4
+BACKPLANE_URL = os.environ.get("NETCONNECT_BACKPLANE", "memory://")
+
+# Upper bound for a single encoded event on the Unix socket (large group fan-outs fit easily)
+MAX_EVENT_BYTES = 16 * 1024 * 1024
+RECONNECT_DELAY_SECONDS = 0.2
+
+EventHandler = Callable[[Dict], Awaitable[None]]
+
+
+def _encode(event: Dict) -> bytes:
+    return json.dumps(event, separators=(",", ":"), default=str).encode("utf-8") + b"\n"
+
+
+def _sequenced(event: Dict) -> bool:
+    """Critical deliveries are numbered; expendable frames are never replayed, so they aren't."""
+    return event.get("op") == "deliver" and event.get("critical", True)
+
+
+class Sequencer:
+    """
+    Per-user sequence numbers for delivered events. The epoch identifies this set of
+    counters; if it changes (restart, broker failover) clients must resync.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex
+        self.seqs: Dict[str, int] = {}
+
+    def stamp(self, usernames: List[str]) -> List[int]:
+        stamped = []
+        for username in usernames:
+            seq = self.seqs.get(username, 0) + 1
+            self.seqs[username] = seq
+            stamped.append(seq)
+        return stamped
+
+    def welcome(self) -> Dict:
+        """Tells a (re)connecting manager where every counter currently stands."""
+        return {"op": "welcome", "epoch": self.epoch, "seqs": dict(self.seqs)}
+
+
+class Backplane:
+    """Base class: publish() hands an event to every subscribed manager, including our own."""
+
+    name = "base"
+
+    def __init__(self, handler: Optional[EventHandler] = None):
+        self.handler = handler
+        self.published = 0
+        self.received = 0
+
+    async def start(self, handler: EventHandler):
+        self.handler = handler
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: Dict):
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        return {"backplane": self.name, "published": self.published, "received": self.received}
+
+
+class InProcessBackplane(Backplane):
+    """Single worker: events go straight back to the local manager."""
+
+    name = "memory"
+
+    def __init__(self, handler: Optional[EventHandler] = None):
+        super().__init__(handler)
+        self.sequencer = Sequencer()
+
+    async def start(self, handler: EventHandler):
+        await super().start(handler)
+        await self.handler(self.sequencer.welcome())
+
+    async def publish(self, event: Dict):
+        if _sequenced(event):
+            event["seqs"] = self.sequencer.stamp(event["users"])
+        self.published += 1
+        self.received += 1
+        await self.handler(event)
+
+
+class _Broker:
+    """
+    Tiny fan-out server on a Unix domain socket. Every line a worker writes is copied to
+    every connected worker (the sender included), so all workers see events in the same order.
+    Critical deliveries are numbered here on the way through.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sequencer = Sequencer()
+        self.clients: Dict[asyncio.StreamWriter, Optional[str]] = {}
+        self.server = None
+        self._tasks = set()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left behind by a broker that died; we hold the lock now
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path, limit=MAX_EVENT_BYTES)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+        # Closing the transports ends each _serve loop with EOF (cancelling them makes asyncio log noise)
+        for writer in list(self.clients):
+            writer.close()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=1)
+        self.clients.clear()
+
+    def _fanout(self, line: bytes):
+        for writer in list(self.clients):
+            if writer.is_closing():
+                continue
+            writer.write(line)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.clients[writer] = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                event = json.loads(line)
+                if event.get("op") == "hello":
+                    self.clients[writer] = event["worker"]
+                    writer.write(_encode(self.sequencer.welcome()))
+                    self._fanout(_encode({"op": "worker_up", "worker": event["worker"]}))
+                    continue
+                if _sequenced(event):
+                    # Splice the numbers in rather than re-encoding the whole event
+                    seqs = json.dumps(self.sequencer.stamp(event["users"]), separators=(",", ":"))
+                    line = b'{"seqs":' + seqs.encode("ascii") + b"," + line[1:]
+                self._fanout(line)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            print(f"Backplane broker: dropping worker connection: {e}")
+        finally:
+            self._tasks.discard(task)
+            worker = self.clients.pop(writer, None)
+            writer.close()
+            if worker:
+                # Let the others forget the presence this worker was holding
+                self._fanout(_encode({"op": "worker_down", "worker": worker}))
+
+
+class UnixSocketBackplane(Backplane):
+    """
+    Local broker for several workers on one machine. Whichever worker grabs the lock file
+    first also hosts the broker; if it dies, a surviving worker takes over on reconnect.
+    Unix-only (fcntl + AF_UNIX).
+    """
+
+    name = "unix"
+
+    def __init__(self, path: str, worker_id: str = None, handler: Optional[EventHandler] = None):
+        super().__init__(handler)
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.worker_id = worker_id or uuid.uuid4().hex
+        self.broker: Optional[_Broker] = None
+        self._lock_fd = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    @property
+    def is_broker(self) -> bool:
+        return self.broker is not None
+
+    async def start(self, handler: EventHandler):
+        await super().start(handler)
+        await self._connect()
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    async def stop(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+            await asyncio.gather(self._read_task, return_exceptions=True)
+        if self._writer is not None:
+            self._writer.close()
+        if self.broker is not None:
+            await self.broker.stop()
+            self.broker = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)  # Releases the flock so another worker can host the broker
+            self._lock_fd = None
+
+    async def _try_become_broker(self):
+        if self.broker is not None:
+            return
+        import fcntl
+        fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return
+        self._lock_fd = fd
+        self.broker = _Broker(self.path)
+        await self.broker.start()
+        print(f"Backplane: worker {self.worker_id} is hosting the broker at {self.path}")
+
+    async def _connect(self):
+        while True:
+            await self._try_become_broker()
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=MAX_EVENT_BYTES)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+                continue
+            self._writer.write(_encode({"op": "hello", "worker": self.worker_id}))
+            await self._writer.drain()
+            return
+
+    async def _read_loop(self):
+        while True:
+            try:
+                line = await self._reader.readline()
+                if not line:
+                    raise ConnectionError("broker closed the connection")
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                print(f"Backplane: lost broker connection ({e}), reconnecting")
+                self._writer = None
+                await self._connect()
+                continue
+            self.received += 1
+            try:
+                await self.handler(json.loads(line))
+            except Exception as e:
+                print(f"Backplane: error handling event: {e}")
+
+    async def publish(self, event: Dict):
+        if self._writer is None or self._writer.is_closing():
+            # Reconnecting to the broker; the event cannot be routed right now
+            self.dropped += 1
+            print(f"Backplane: not connected, dropped {event.get('op')} event")
+            return
+        self.published += 1
+        self._writer.write(_encode(event))
+        await self._writer.drain()
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        stats.update({"path": self.path, "is_broker": self.is_broker, "dropped": self.dropped})
+        return stats
+
+
+def create_backplane(url: str = BACKPLANE_URL, worker_id: str = None) -> Backplane:
+    if url.startswith("memory://"):
+        return InProcessBackplane()
+    if url.startswith("unix://"):
+        return UnixSocketBackplane(url[len("unix://"):], worker_id=worker_id)
+    raise ValueError(f"Unsupported backplane URL: {url}")
@@ -0,0 +1,98 @@
+# In benchmarks/backplane_latency.py
+#
+# Cross-worker delivery latency through the Unix socket backplane. Starts N worker processes
+# on one unix:// backplane (one of them ends up hosting the broker), has worker 0 publish
+# deliveries addressed to users on the other workers, and measures how long each takes to reach
+# the worker that holds the recipient. Latency is taken on time.monotonic(), which is
+# system-wide on Linux, so sender and receiver clocks agree.
+# Exits non-zero if a delivery is lost or p99 exceeds LATENCY_BUDGET_MS, so it can run in CI.
+#
+# Run from the directory that contains the app package:
+#   python -m app.benchmarks.backplane_latency [workers] [deliveries]
+
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from app.backplane import UnixSocketBackplane
+
+LATENCY_BUDGET_MS = 50
+SEND_INTERVAL = 0.001  # Between deliveries, like a busy but not saturated worker
+SETTLE_SECONDS = 1.0  # Wait for stragglers after the last delivery
+
+
+def _worker(index: int, workers: int, deliveries: int, path: str, ready, go, stop, results):
+    async def run():
+        latencies = []
+
+        async def handle(event):
+            if event.get("op") == "deliver" and event["message"].get("to_worker") == index:
+                latencies.append(time.monotonic() - event["message"]["sent_at"])
+
+        backplane = UnixSocketBackplane(path, worker_id=f"worker{index}")
+        await backplane.start(handle)
+        ready.put(index)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, go.wait)
+        if index == 0:
+            for n in range(deliveries):
+                target = 1 + n % (workers - 1)  # Never ourselves: that wouldn't cross workers
+                await backplane.publish({"op": "deliver", "users": [f"user{target}"], "critical": True,
+                                         "message": {"to_worker": target, "sent_at": time.monotonic()}})
+                await asyncio.sleep(SEND_INTERVAL)
+            ready.put("sent")
+        await loop.run_in_executor(None, stop.wait)
+        results.put((index, latencies))
+        await backplane.stop()
+
+    asyncio.run(run())
+
+
+def main(workers: int = 4, deliveries: int = 2000) -> int:
+    if workers < 2:
+        print("Need at least 2 workers")
+        return 1
+    context = multiprocessing.get_context("spawn")
+    ready, results = context.Queue(), context.Queue()
+    go, stop = context.Event(), context.Event()
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, "backplane.sock")
+        processes = [context.Process(target=_worker, args=(i, workers, deliveries, path, ready, go, stop, results))
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+        for _ in range(workers):
+            ready.get(timeout=30)
+        started = time.perf_counter()
+        go.set()
+        ready.get()  # Worker 0 has published everything; let the last events land
+        time.sleep(SETTLE_SECONDS)
+        stop.set()
+        latencies = []
+        for _ in range(workers):
+            _, received = results.get(timeout=60)
+            latencies.extend(received)
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join(timeout=10)
+
+    latencies.sort()
+    print(f"{workers} workers, {deliveries} deliveries from worker 0 in {elapsed:.1f} s, {len(latencies)} received")
+    if len(latencies) < deliveries:
+        print(f"FAIL {deliveries - len(latencies)} deliveries lost")
+        return 1
+    p50 = latencies[len(latencies) // 2] * 1e3
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e3
+    print(f"cross-worker latency p50 {p50:.2f} ms   p99 {p99:.2f} ms   max {latencies[-1] * 1e3:.2f} ms")
+    if p99 > LATENCY_BUDGET_MS:
+        print(f"FAIL p99 {p99:.2f} ms, budget {LATENCY_BUDGET_MS} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    sys.exit(main(*args))
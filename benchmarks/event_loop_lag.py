@@ -0,0 +1,87 @@
+# In benchmarks/event_loop_lag.py
+#
+# Event-loop lag while many sockets write messages at once, with the inserts+commits done the
+# old way (synchronous Session calls on the loop) and the new way (run_in_db_thread). Lag is
+# how late a 10 ms timer fires; on the loop every commit's fsync shows up as lag for everybody.
+#
+# Uses a scratch SQLite file with the app's schema, never netconnect.db.
+# Run from the directory that contains the app package:
+#   python -m app.benchmarks.event_loop_lag [senders] [messages_per_sender]
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base, run_in_db_thread
+from app.models import Message, User
+
+PROBE_INTERVAL = 0.01
+
+
+def _insert(session_factory, sender_id: int, receiver_id: int, content: str):
+    db = session_factory()
+    try:
+        db.add(Message(sender_id=sender_id, receiver_id=receiver_id, content=content, timestamp=datetime.utcnow()))
+        db.commit()
+    finally:
+        db.close()
+
+
+async def _probe(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+
+async def _run(mode: str, session_factory, senders: int, per_sender: int):
+    async def sender(index: int):
+        for n in range(per_sender):
+            if mode == "on_loop":
+                _insert(session_factory, 1, 2, f"{index}:{n}")
+            else:
+                await run_in_db_thread(_insert, session_factory, 1, 2, f"{index}:{n}")
+            await asyncio.sleep(0)  # Like a socket waiting for its next frame
+
+    stop = asyncio.Event()
+    lags = []
+    probe = asyncio.create_task(_probe(stop, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(i) for i in range(senders)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    lags.sort()
+    if not lags:
+        lags = [0.0]
+    total = senders * per_sender
+    print(f"{mode:<10} {total / elapsed:>8.0f} msg/s   loop lag p50 {lags[len(lags) // 2] * 1e3:7.2f} ms"
+          f"   p99 {lags[int(len(lags) * 0.99)] * 1e3:7.2f} ms   max {lags[-1] * 1e3:7.2f} ms")
+
+
+def main(senders: int = 50, per_sender: int = 20):
+    with tempfile.TemporaryDirectory() as scratch:
+        engine = create_engine(f"sqlite:///{os.path.join(scratch, 'bench.db')}",
+                               connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=engine)
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        db = session_factory()
+        db.add_all([User(id=1, name="a", email="a@x", contact="1", username="a", hashed_password="x"),
+                    User(id=2, name="b", email="b@x", contact="2", username="b", hashed_password="x")])
+        db.commit()
+        db.close()
+        print(f"{senders} concurrent senders x {per_sender} messages")
+        for mode in ("on_loop", "db_thread"):
+            asyncio.run(_run(mode, session_factory, senders, per_sender))
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*args)
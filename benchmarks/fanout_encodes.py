@@ -0,0 +1,112 @@
+# In benchmarks/fanout_encodes.py
+#
+# Encodes and CPU per group message, sent to every member of a large group:
+#   per member  - the old way, one WebSocket.send_json (so one json.dumps) per member
+#   Frame       - one Frame encode, a per-member "seq" spliced into it, send_text per member
+#   manager     - the full ConnectionManager.send_to_users path: backplane, sequencing, outboxes,
+#                 per-connection queues and writer tasks (the last two predate Frame)
+# The sockets are in-memory stand-ins, so only the server-side work is measured.
+#
+# Run from the directory that contains the app package:
+#   python -m app.benchmarks.fanout_encodes [members] [messages]
+
+import asyncio
+import json
+import sys
+import time
+
+from app.backplane import InProcessBackplane
+from app.frames import Frame
+from app.websocket_manager import Connection, ConnectionManager
+
+SAMPLE_MESSAGE = {
+    "type": "group_message",
+    "from": "adeola",
+    "group": "network-team",
+    "content": "Meeting moved to 3pm, bring the LAN switch quotes",
+    "file_path": None,
+    "file_type": None,
+    "timestamp": "2025-06-14 15:02:11.482913+01:00",
+}
+
+
+class FakeWebSocket:
+    """Accepts frames and counts them; send_json encodes like Starlette's."""
+
+    encodes = 0
+    received = 0
+    expected = 0
+    done: asyncio.Event = None
+
+    async def send_json(self, data):
+        FakeWebSocket.encodes += 1
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    async def send_text(self, text: str):
+        FakeWebSocket.received += 1
+        if FakeWebSocket.received == FakeWebSocket.expected:
+            FakeWebSocket.done.set()
+
+    async def send_bytes(self, data: bytes):
+        await self.send_text("")
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+async def _per_member(members: int, messages: int) -> float:
+    sockets = [FakeWebSocket() for _ in range(members)]
+    started = time.perf_counter()
+    for _ in range(messages):
+        for websocket in sockets:
+            await websocket.send_json(SAMPLE_MESSAGE)
+    return time.perf_counter() - started
+
+
+async def _frame(members: int, messages: int) -> float:
+    sockets = [FakeWebSocket() for _ in range(members)]
+    started = time.perf_counter()
+    for n in range(messages):
+        frame = Frame(SAMPLE_MESSAGE)
+        for websocket in sockets:
+            await websocket.send_text(frame.sequenced(n + 1).text)
+    return time.perf_counter() - started
+
+
+async def _manager(members: int, messages: int) -> float:
+    manager = ConnectionManager(backplane=InProcessBackplane())
+    await manager.backplane.start(manager._handle_event)
+    usernames = [f"member{i}" for i in range(members)]
+    for username in usernames:
+        connection = Connection(username, FakeWebSocket(), manager, max_queue=messages + 1)
+        connection.start()
+        manager.active_connections[username] = {"device": connection}
+    FakeWebSocket.received, FakeWebSocket.expected = 0, members * messages
+    FakeWebSocket.done = asyncio.Event()
+    started = time.perf_counter()
+    for _ in range(messages):
+        await manager.send_to_users(SAMPLE_MESSAGE, usernames)
+    await FakeWebSocket.done.wait()  # Every writer task has sent every frame
+    elapsed = time.perf_counter() - started
+    for devices in manager.active_connections.values():
+        for connection in devices.values():
+            await connection.close()
+    return elapsed
+
+
+def main(members: int = 500, messages: int = 50):
+    print(f"{messages} group messages to {members} members each")
+    print(f"{'fan-out':<14}{'encodes':>10}{'per message':>13}{'ms per message':>16}")
+    elapsed = asyncio.run(_per_member(members, messages))
+    print(f"{'per member':<14}{FakeWebSocket.encodes:>10}{FakeWebSocket.encodes / messages:>13.0f}"
+          f"{elapsed / messages * 1e3:>16.2f}")
+    for name, run in (("Frame", _frame), ("manager", _manager)):
+        before = Frame.encodes
+        elapsed = asyncio.run(run(members, messages))
+        encodes = Frame.encodes - before
+        print(f"{name:<14}{encodes:>10}{encodes / messages:>13.0f}{elapsed / messages * 1e3:>16.2f}")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,88 @@
+# In benchmarks/frame_codec.py
+#
+# Bytes on the wire and encode/decode CPU for the two WebSocket protocols (JSON text frames
+# and the compact "msgpack" subprotocol), over the frames clients receive most often.
+#
+# Run from the directory that contains the app package:
+#   python -m app.benchmarks.frame_codec [iterations]
+
+import json
+import sys
+import time
+
+from app import frames
+
+SAMPLE_FRAMES = {
+    "direct_message": {
+        "type": "direct_message",
+        "id": 48213,
+        "from": "adeola",
+        "to": "chinedu",
+        "content": "Meeting moved to 3pm, bring the LAN switch quotes",
+        "file_path": None,
+        "file_type": None,
+        "timestamp": "2025-06-14T15:02:11.482913+01:00",
+        "is_group": False,
+    },
+    "group_message": {
+        "type": "group_message",
+        "id": 90112,
+        "group": "network-team",
+        "from": "adeola",
+        "content": "Forwarding this here",
+        "file_path": "uploaded_files/2025/06/floorplan.pdf",
+        "file_type": "application/pdf",
+        "timestamp": "2025-06-14T15:02:11.482913+01:00",
+        "is_group": True,
+        "forwarded_from": "chinedu",
+    },
+    "chat_preview_update": {
+        "type": "chat_preview_update",
+        "chat_type": "group",
+        "chat_id": "network-team",
+        "last_message": "Forwarding this here",
+        "unread_count": 4,
+        "timestamp": "2025-06-14T15:02:11.482913+01:00",
+        "is_group": True,
+    },
+    "message_status": {"type": "message_status", "message_id": 48213, "status": "read"},
+    "presence_diff": {
+        "type": "presence_diff",
+        "changes": [{"username": "user%d" % i, "status": "online" if i % 2 else "offline"} for i in range(5)],
+    },
+}
+
+
+def _timed(fn, iterations: int) -> float:
+    """Microseconds per call."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run(iterations: int = 20000):
+    if frames.msgpack is None:
+        print("msgpack is not installed; pip install msgpack")
+        return
+    print(f"{'frame':<22}{'json B':>8}{'msgpack B':>11}{'saved':>8}"
+          f"{'json enc us':>13}{'mp enc us':>11}{'json dec us':>13}{'mp dec us':>11}")
+    totals = [0, 0]
+    for name, payload in SAMPLE_FRAMES.items():
+        text = frames.dumps(payload)
+        packed = frames.packb(payload)
+        assert frames.unpackb(packed) == json.loads(text)  # The compact form round-trips
+        json_bytes, msgpack_bytes = len(text.encode("utf-8")), len(packed)
+        totals[0] += json_bytes
+        totals[1] += msgpack_bytes
+        print(f"{name:<22}{json_bytes:>8}{msgpack_bytes:>11}{1 - msgpack_bytes / json_bytes:>8.0%}"
+              f"{_timed(lambda: frames.dumps(payload), iterations):>13.2f}"
+              f"{_timed(lambda: frames.packb(payload), iterations):>11.2f}"
+              f"{_timed(lambda: json.loads(text), iterations):>13.2f}"
+              f"{_timed(lambda: frames.unpackb(packed), iterations):>11.2f}")
+    print(f"{'total':<22}{totals[0]:>8}{totals[1]:>11}{1 - totals[1] / totals[0]:>8.0%}")
+    print(f"JSON encoder: {'orjson' if frames.orjson is not None else 'json'}, {iterations} iterations each")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,66 @@
+# In benchmarks/login_burst.py
+#
+# Event-loop lag during a burst of logins, with bcrypt verified the old way (directly on the loop)
+# and the new way (verify_and_update_password on the hash pool). Lag is how late a 10 ms timer
+# fires; on the loop every verification freezes all sockets for the full bcrypt cost.
+# Exits non-zero if the hash pool lets p99 lag exceed LAG_BUDGET_MS, so it can run in CI.
+#
+# Run from the directory that contains the app package:
+#   python -m app.benchmarks.login_burst [logins]
+
+import asyncio
+import sys
+import time
+
+from app.auth import hash_pool, pwd_context, verify_and_update_password
+
+PROBE_INTERVAL = 0.01
+LAG_BUDGET_MS = 50
+
+
+async def _probe(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+
+async def _run(mode: str, hashed: str, logins: int) -> float:
+    async def login():
+        if mode == "on_loop":
+            valid = pwd_context.verify("secret", hashed)
+        else:
+            valid, _ = await verify_and_update_password("secret", hashed)
+        assert valid
+
+    stop = asyncio.Event()
+    lags = []
+    probe = asyncio.create_task(_probe(stop, lags))
+    await asyncio.sleep(PROBE_INTERVAL * 2)  # Let the probe take a baseline
+    started = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)] * 1e3
+    print(f"{mode:<10} {logins / elapsed:>6.1f} logins/s   loop lag p50 {lags[len(lags) // 2] * 1e3:7.2f} ms"
+          f"   p99 {p99:7.2f} ms   max {lags[-1] * 1e3:7.2f} ms")
+    return p99
+
+
+def main(logins: int = 16) -> int:
+    hashed = pwd_context.hash("secret")
+    print(f"{logins} concurrent logins, {hash_pool.threads} hash threads")
+    asyncio.run(_run("on_loop", hashed, logins))
+    p99 = asyncio.run(_run("hash_pool", hashed, logins))
+    print(f"hash pool: {hash_pool.stats()}")
+    if p99 > LAG_BUDGET_MS:
+        print(f"FAIL loop lag p99 {p99:.2f} ms with the hash pool, budget {LAG_BUDGET_MS} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:2]]
+    sys.exit(main(*args))
@@ -0,0 +1,106 @@
+# In benchmarks/query_counts.py
+#
+# Statement-count regression check for the history and chat list endpoints. Seeds a scratch
+# database with a small and a large history, calls the route functions directly and counts the SQL
+# statements each call executes. The count must not depend on the number of messages or chats
+# (no N+1 queries).
+# Exits non-zero on a regression, so it can run in CI.
+#
+# Run from the directory that contains the app package:
+#   python -m app.benchmarks.query_counts
+
+import os
+import sys
+import tempfile
+
+from sqlalchemy import create_engine, event
+
+from app.database import Base, RoutingSession
+from app.models import Group, GroupMessage, GroupReadMark, Message, User
+from app.routes.messages import get_conversation, get_group_messages, get_user_chats
+
+# History sizes to compare; the statement count must be the same for all of them
+SIZES = (10, 500)
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def seed(db, size: int):
+    alice, bob, carol = (User(username=name, name=name, email=f"{name}@example.com") for name in ("alice", "bob", "carol"))
+    group = Group(name="dept", members=[alice, bob, carol])
+    db.add_all([alice, bob, carol, group])
+    db.flush()
+    for i in range(size):
+        sender = (alice, bob, carol)[i % 3]
+        # Some rows from senders that no longer exist, as system messages are stored
+        db.add(GroupMessage(group_id=group.id, sender_id=sender.id if i % 7 else None,
+                            sender_username=sender.username, content=f"group {i}"))
+        db.add(Message(sender_id=(alice, bob)[i % 2].id, receiver_id=(bob, alice)[i % 2].id, content=f"direct {i}"))
+    # One more direct chat for bob per ten messages, so the chat list grows too
+    for i in range(size // 10):
+        peer = User(username=f"peer{i}", name=f"peer{i}", email=f"peer{i}@example.com")
+        db.add(peer)
+        db.flush()
+        db.add(Message(sender_id=peer.id, receiver_id=bob.id, content=f"hello {i}"))
+    db.flush()
+    # bob has read the first half of the group
+    db.add(GroupReadMark(group_id=group.id, user_id=bob.id, last_read_message_id=size // 2))
+    db.commit()
+
+
+def count_statements(size: int) -> dict:
+    with tempfile.TemporaryDirectory() as scratch:
+        engine = create_engine(f"sqlite:///{os.path.join(scratch, 'counts.db')}")
+        Base.metadata.create_all(bind=engine)
+        db = RoutingSession(writer=engine, reader=engine)
+        seed(db, size)
+        db.close()
+
+        counter = StatementCounter(engine)
+        counts = {}
+        # Query() defaults only resolve inside FastAPI, so every parameter is passed explicitly
+        calls = {
+            "conversation": lambda db, bob: get_conversation(
+                "alice", "bob", before_id=None, after_id=None, limit=None, stream=False, db=db),
+            "conversation page": lambda db, bob: get_conversation(
+                "alice", "bob", before_id=None, after_id=None, limit=50, stream=False, db=db),
+            "group messages": lambda db, bob: get_group_messages(
+                "dept", before_id=None, after_id=None, limit=None, stream=False, db=db, current_user=bob),
+            "group page": lambda db, bob: get_group_messages(
+                "dept", before_id=None, after_id=None, limit=50, stream=False, db=db, current_user=bob),
+            "chats": lambda db, bob: {"messages": get_user_chats(db=db, current_user=bob)},
+        }
+        for name, call in calls.items():
+            db = RoutingSession(writer=engine, reader=engine)
+            bob = db.query(User).filter(User.username == "bob").first()
+            counter.count = 0
+            result = call(db, bob)
+            counts[name] = (counter.count, len(result["messages"]))
+            db.close()
+        engine.dispose()
+    return counts
+
+
+def main() -> int:
+    results = {size: count_statements(size) for size in SIZES}
+    failures = 0
+    for name in results[SIZES[0]]:
+        statements = [results[size][name][0] for size in SIZES]
+        constant = len(set(statements)) == 1
+        detail = ", ".join(f"{results[size][name][1]} messages: {results[size][name][0]} statements" for size in SIZES)
+        print(f"{'ok' if constant else 'FAIL':<5} {name:<20} {detail}")
+        failures += not constant
+    if failures:
+        print(f"{failures} endpoint{'' if failures == 1 else 's'} ran more statements for a longer history")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+# In benchmarks/query_plans.py
+#
+# EXPLAIN QUERY PLAN regression check for the hot query shapes (conversation history and pages,
+# unread counts, chat list and its summary rows, group history, read marks, group membership).
+# Builds a scratch database from the models, plans each query and fails if any of them scans one
+# of the big tables instead of searching an index. Exits non-zero on a regression, so it can run in CI.
+#
+# Run from the directory that contains the app package:
+#   python -m app.benchmarks.query_plans
+
+import os
+import sys
+import tempfile
+
+from sqlalchemy import create_engine, func, select, text
+
+from app.database import Base
+from app.chat_summaries import unread_in_group
+from app.models import ChatSummary, GroupMessage, GroupReadMark, Message, User, conversation_key, user_group
+
+# Tables that must never be read with a full scan by the queries below
+CHECKED_TABLES = {"messages", "group_messages", "group_read_marks", "user_group", "chat_summaries"}
+
+ME, PEER, GROUP = 1, 2, 1
+
+QUERIES = {
+    "conversation history": select(Message).where(
+        Message.conversation_id == conversation_key(ME, PEER)).order_by(Message.timestamp),
+    "direct last message": select(Message).where(
+        Message.conversation_id == conversation_key(ME, PEER)).order_by(Message.timestamp.desc()).limit(1),
+    "conversation page": select(Message).where(
+        Message.conversation_id == conversation_key(ME, PEER), Message.id < 1000).order_by(Message.id.desc()).limit(51),
+    "conversation catch-up": select(Message).where(
+        Message.conversation_id == conversation_key(ME, PEER), Message.id > 1000).order_by(Message.id).limit(51),
+    "direct unread count": select(func.count()).select_from(Message).where(
+        Message.sender_id == PEER, Message.receiver_id == ME, Message.is_read == False),
+    "chat list peers": select(Message.sender_id).where(Message.receiver_id == ME).union(
+        select(Message.receiver_id).where(Message.sender_id == ME)),
+    "group history": select(GroupMessage).where(GroupMessage.group_id == GROUP).order_by(GroupMessage.timestamp),
+    "group page": select(GroupMessage).where(
+        GroupMessage.group_id == GROUP, GroupMessage.id < 1000).order_by(GroupMessage.id.desc()).limit(51),
+    "group catch-up": select(GroupMessage).where(
+        GroupMessage.group_id == GROUP, GroupMessage.id > 1000).order_by(GroupMessage.id).limit(51),
+    "group unread count": select(unread_in_group(GROUP, ME)),
+    "read mark probe": select(GroupReadMark.last_read_message_id).where(
+        GroupReadMark.group_id == GROUP, GroupReadMark.user_id == ME),
+    "seen by": select(User.username).join(GroupReadMark, GroupReadMark.user_id == User.id).where(
+        GroupReadMark.group_id == GROUP, GroupReadMark.last_read_message_id >= 10, User.id != ME),
+    "chat list": select(ChatSummary).where(ChatSummary.user_id == ME).order_by(ChatSummary.last_ts.desc()),
+    "group chat rows": select(ChatSummary).where(ChatSummary.chat_type == "group", ChatSummary.chat_id == GROUP),
+    "group members": select(user_group.c.user_id).where(user_group.c.group_id == GROUP),
+    "user's groups": select(user_group.c.group_id).where(user_group.c.user_id == ME),
+}
+
+
+def full_scans(plan_rows) -> list:
+    """Plan lines that read a checked table front to back."""
+    scans = []
+    for row in plan_rows:
+        detail = row[-1]
+        words = detail.split()
+        if len(words) >= 2 and words[0] == "SCAN" and words[1] in CHECKED_TABLES:
+            scans.append(detail)
+    return scans
+
+
+def main() -> int:
+    failures = 0
+    with tempfile.TemporaryDirectory() as scratch:
+        engine = create_engine(f"sqlite:///{os.path.join(scratch, 'plans.db')}")
+        Base.metadata.create_all(bind=engine)
+        with engine.connect() as connection:
+            for name, statement in QUERIES.items():
+                sql = str(statement.compile(engine, compile_kwargs={"literal_binds": True}))
+                plan = connection.execute(text("EXPLAIN QUERY PLAN " + sql)).fetchall()
+                scans = full_scans(plan)
+                print(f"{'FAIL' if scans else 'ok':<5} {name}")
+                for row in plan:
+                    print(f"        {row[-1]}")
+                failures += bool(scans)
+        engine.dispose()
+    if failures:
+        print(f"{failures} quer{'y' if failures == 1 else 'ies'} fell back to a full table scan")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# In benchmarks/sqlite_contention.py
+#
+# Concurrent REST-style traffic against SQLite: worker threads (like FastAPI's threadpool) mixing
+# short reads with INSERT+COMMITs, first on a plain engine (the old database.py: rollback journal,
+# default pool, no pragmas) and then on the production profile (WAL pragmas, single writer
+# connection, read-only reader pool behind RoutingSession). Reports throughput, latency and
+# "database is locked" errors.
+#
+# Uses a scratch SQLite file per run, never netconnect.db.
+# Run from the directory that contains the app package:
+#   python -m app.benchmarks.sqlite_contention [threads] [ops_per_thread] [write_percent]
+
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base, RoutingSession, create_sqlite_engine
+from app.models import Message, User
+
+
+def _setup(session_factory):
+    db = session_factory()
+    db.add_all([User(id=1, name="a", email="a@x", contact="1", username="a", hashed_password="x"),
+                User(id=2, name="b", email="b@x", contact="2", username="b", hashed_password="x")])
+    db.add_all([Message(sender_id=1, receiver_id=2, content=f"seed {n}", timestamp=datetime.utcnow())
+                for n in range(2000)])
+    db.commit()
+    db.close()
+
+
+def _worker(session_factory, ops: int, write_percent: int, latencies: dict, errors: list):
+    rng = random.Random()
+    for _ in range(ops):
+        started = time.perf_counter()
+        kind = "write" if rng.randrange(100) < write_percent else "read"
+        db = session_factory()
+        try:
+            if kind == "write":
+                db.add(Message(sender_id=1, receiver_id=2, content="x", timestamp=datetime.utcnow()))
+                db.commit()
+            else:
+                db.query(func.count(Message.id)).filter(Message.receiver_id == 2, Message.is_read == False).scalar()
+                db.query(Message).order_by(Message.id.desc()).limit(20).all()
+        except OperationalError as e:
+            errors.append(str(e.orig))
+            db.rollback()
+        finally:
+            db.close()
+        latencies[kind].append(time.perf_counter() - started)
+
+
+def _run(name: str, session_factory, threads: int, ops: int, write_percent: int):
+    latencies, errors = {"read": [], "write": []}, []
+    workers = [threading.Thread(target=_worker, args=(session_factory, ops, write_percent, latencies, errors))
+               for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    locked = sum(1 for error in errors if "locked" in error)
+    total = len(latencies["read"]) + len(latencies["write"])
+    print(f"{name:<6} {total / elapsed:>6.0f} ops/s   errors {len(errors)} (locked {locked})")
+    for kind, values in latencies.items():
+        values.sort()
+        if values:
+            print(f"    {kind:<6} p50 {values[len(values) // 2] * 1e3:8.2f} ms   p99 {values[int(len(values) * 0.99)] * 1e3:8.2f} ms")
+
+
+def main(threads: int = 32, ops: int = 200, write_percent: int = 20):
+    print(f"{threads} threads x {ops} ops, {write_percent}% writes")
+    with tempfile.TemporaryDirectory() as scratch:
+        url = f"sqlite:///{os.path.join(scratch, 'plain.db')}"
+        plain = create_engine(url, connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=plain)
+        factory = sessionmaker(autocommit=False, autoflush=False, bind=plain)
+        _setup(factory)
+        _run("plain", factory, threads, ops, write_percent)
+        plain.dispose()
+
+        url = f"sqlite:///{os.path.join(scratch, 'tuned.db')}"
+        writer = create_sqlite_engine(url)
+        reader = create_sqlite_engine(url, readonly=True)
+        Base.metadata.create_all(bind=writer)
+        factory = sessionmaker(autocommit=False, autoflush=False, class_=RoutingSession, writer=writer, reader=reader)
+        _setup(factory)
+        _run("tuned", factory, threads, ops, write_percent)
+        writer.dispose()
+        reader.dispose()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:4]])
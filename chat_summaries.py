@@ -0,0 +1,247 @@
+# In chat_summaries.py
+#
+# Upkeep of the chat_summaries table behind GET /chats: one row per (user, chat) holding the last
+# message preview and that user's unread count. Rows are written in the same flush as the
+# messages themselves, so every ORM path that sends, forwards, deletes or reads messages (REST,
+# WebSocket, the batching ingestor, group creation) keeps them current:
+#   - new messages move the preview and bump the recipients' unread counts, with one upsert per
+#     conversation or group per flush, so an ingest batch stays a handful of statements
+#   - deletes and read-state changes recompute only the rows they touch
+# Bulk Query.update() calls don't fire flush events; call refresh_direct() after those. Group read
+# state is a per-member watermark, moved with advance_read_mark().
+
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import case, delete, event, func, inspect, literal, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from app.models import ChatSummary, Group, GroupMessage, GroupReadMark, Message, conversation_key, user_group
+
+DIRECT = "direct"
+GROUP = "group"
+
+summaries = ChatSummary.__table__
+CHAT_KEY = [summaries.c.user_id, summaries.c.chat_type, summaries.c.chat_id]
+LAST_COLUMNS = ("last_message_id", "last_message", "last_sender_id", "last_is_read", "last_ts")
+
+
+def preview_text(content: Optional[str], file_path: Optional[str]) -> str:
+    """What /chats shows for a message: the text, or "<file name>: <text>" for attachments."""
+    if file_path:
+        file_name = file_path.split("/")[-1]
+        if content and content.strip():
+            return f"{file_name}: {content.strip()}"
+        return file_name
+    return content or ""
+
+
+def _last_values(message, is_read: Optional[bool] = None) -> Dict:
+    """The last_* columns for a message object or row; is_read only matters for direct chats."""
+    return {
+        "last_message_id": message.id,
+        "last_message": preview_text(message.content, message.file_path),
+        "last_sender_id": message.sender_id,
+        "last_is_read": is_read,
+        "last_ts": message.timestamp,
+    }
+
+
+# Columns _last_values() reads, for the recompute queries
+MESSAGE_COLUMNS = (Message.id, Message.content, Message.file_path, Message.sender_id, Message.is_read, Message.timestamp)
+GROUP_MESSAGE_COLUMNS = (GroupMessage.id, GroupMessage.content, GroupMessage.file_path, GroupMessage.sender_id,
+                         GroupMessage.timestamp)
+
+
+def _upsert(statement, incremental: bool):
+    """
+    ON CONFLICT for chat rows. Incremental upserts (new messages) only move the preview forward
+    and add to unread_count; the others (recomputes) replace the row's values outright.
+    """
+    excluded = statement.excluded
+    if not incremental:
+        return statement.on_conflict_do_update(
+            index_elements=CHAT_KEY, set_={name: excluded[name] for name in (*LAST_COLUMNS, "unread_count")})
+    newer = excluded.last_message_id > func.coalesce(summaries.c.last_message_id, 0)
+    values = {name: case((newer, excluded[name]), else_=summaries.c[name]) for name in LAST_COLUMNS}
+    values["unread_count"] = summaries.c.unread_count + excluded.unread_count
+    return statement.on_conflict_do_update(index_elements=CHAT_KEY, set_=values)
+
+
+ADD_ROWS = _upsert(insert(summaries), incremental=True)
+REPLACE_ROWS = _upsert(insert(summaries), incremental=False)
+
+
+def _add_direct(connection, messages: List[Message]):
+    # Last message and unread count per (user, peer) across the whole flush
+    last: Dict[Tuple[int, int], Message] = {}
+    unread: Dict[Tuple[int, int], int] = defaultdict(int)
+    for message in messages:
+        for pair in ((message.sender_id, message.receiver_id), (message.receiver_id, message.sender_id)):
+            if pair not in last or message.id > last[pair].id:
+                last[pair] = message
+        if not message.is_read:
+            unread[(message.receiver_id, message.sender_id)] += 1
+    rows = [
+        {"user_id": user_id, "chat_type": DIRECT, "chat_id": peer_id, "unread_count": unread[(user_id, peer_id)],
+         **_last_values(message, bool(message.is_read))}
+        for (user_id, peer_id), message in last.items()
+    ]
+    if rows:
+        connection.execute(ADD_ROWS, rows)
+
+
+def _add_group(connection, messages: List[GroupMessage]):
+    by_group: Dict[int, List[GroupMessage]] = defaultdict(list)
+    for message in messages:
+        by_group[message.group_id].append(message)
+    for group_id, group_messages in by_group.items():
+        last = max(group_messages, key=lambda m: m.id)
+        # Unread for a member: messages from someone else (system messages have no sender and don't count)
+        senders: Dict[int, int] = defaultdict(int)
+        for message in group_messages:
+            if message.sender_id is not None:
+                senders[message.sender_id] += 1
+        unread = literal(sum(senders.values()))
+        if senders:
+            unread = unread - case(senders, value=user_group.c.user_id, else_=0)
+        members = select(
+            user_group.c.user_id, literal(GROUP), literal(group_id),
+            *(literal(value) for value in _last_values(last).values()), unread,
+        ).where(user_group.c.group_id == group_id).distinct()
+        statement = insert(summaries).from_select(
+            ["user_id", "chat_type", "chat_id", *LAST_COLUMNS, "unread_count"], members)
+        connection.execute(_upsert(statement, incremental=True))
+
+
+def _add_groups(connection, groups: List[Group]):
+    """Empty rows for the members of new groups, so they show up in /chats before any message."""
+    for group in groups:
+        members = select(user_group.c.user_id, literal(GROUP), literal(group.id), literal(0)).where(
+            user_group.c.group_id == group.id).distinct()
+        connection.execute(insert(summaries).from_select(
+            ["user_id", "chat_type", "chat_id", "unread_count"], members).on_conflict_do_nothing())
+
+
+def refresh_direct(connection, user_a: int, user_b: int):
+    """Recompute both users' rows for their direct chat from the messages table."""
+    last = connection.execute(
+        select(*MESSAGE_COLUMNS).where(Message.conversation_id == conversation_key(user_a, user_b))
+        .order_by(Message.id.desc()).limit(1)
+    ).first()
+    pairs = {(user_a, user_b), (user_b, user_a)}
+    if last is None:
+        for user_id, peer_id in pairs:
+            connection.execute(delete(summaries).where(
+                summaries.c.user_id == user_id, summaries.c.chat_type == DIRECT, summaries.c.chat_id == peer_id))
+        return
+    rows = []
+    for user_id, peer_id in pairs:
+        unread = connection.execute(select(func.count()).select_from(Message).where(
+            Message.sender_id == peer_id, Message.receiver_id == user_id, Message.is_read == False)).scalar()
+        rows.append({"user_id": user_id, "chat_type": DIRECT, "chat_id": peer_id, "unread_count": unread,
+                     **_last_values(last, last.is_read)})
+    connection.execute(REPLACE_ROWS, rows)
+
+
+def read_mark(group_id: int, user_id):
+    """The member's watermark as a scalar subquery; 0 if they never read the group."""
+    return func.coalesce(select(GroupReadMark.last_read_message_id).where(
+        GroupReadMark.group_id == group_id, GroupReadMark.user_id == user_id).scalar_subquery(), 0)
+
+
+def unread_in_group(group_id: int, user_id):
+    """Messages in the group from someone else above the member's watermark."""
+    return select(func.count()).select_from(GroupMessage).where(
+        GroupMessage.group_id == group_id, GroupMessage.id > read_mark(group_id, user_id),
+        GroupMessage.sender_id != user_id).scalar_subquery()
+
+
+def refresh_group_unread(connection, group_id: int, user_id: int):
+    connection.execute(update(summaries).where(
+        summaries.c.user_id == user_id, summaries.c.chat_type == GROUP, summaries.c.chat_id == group_id,
+    ).values(unread_count=unread_in_group(group_id, user_id)))
+
+
+def advance_read_mark(connection, group_id: int, user_id: int, message_id: int):
+    """Mark everything in the group up to message_id as read; watermarks never move back."""
+    statement = insert(GroupReadMark.__table__).values(
+        group_id=group_id, user_id=user_id, last_read_message_id=message_id)
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[GroupReadMark.group_id, GroupReadMark.user_id],
+        set_={"last_read_message_id": func.max(
+            GroupReadMark.last_read_message_id, statement.excluded.last_read_message_id)},
+    ))
+    refresh_group_unread(connection, group_id, user_id)
+
+
+def unread_count(db: Session, user_id: int, chat_type: str, chat_id: int) -> int:
+    """A user's unread counter for one chat."""
+    return db.query(ChatSummary.unread_count).filter(
+        ChatSummary.user_id == user_id, ChatSummary.chat_type == chat_type, ChatSummary.chat_id == chat_id
+    ).scalar() or 0
+
+
+def group_unread_counts(db: Session, group_id: int) -> Dict[int, int]:
+    """Every member's unread counter for a group in one query: user id -> count."""
+    return dict(db.query(ChatSummary.user_id, ChatSummary.unread_count).filter(
+        ChatSummary.chat_type == GROUP, ChatSummary.chat_id == group_id).all())
+
+
+def _refresh_group_last(connection, group_id: int):
+    last = connection.execute(
+        select(*GROUP_MESSAGE_COLUMNS).where(GroupMessage.group_id == group_id).order_by(GroupMessage.id.desc()).limit(1)
+    ).first()
+    values = _last_values(last) if last else dict.fromkeys(LAST_COLUMNS)
+    connection.execute(update(summaries).where(
+        summaries.c.chat_type == GROUP, summaries.c.chat_id == group_id).values(**values))
+
+
+def _uncount_group_messages(connection, messages: List[GroupMessage]):
+    """Take deleted messages off the unread count of every member that hadn't read them."""
+    for message in messages:
+        if message.sender_id is None:
+            continue
+        readers = select(GroupReadMark.user_id).where(
+            GroupReadMark.group_id == message.group_id, GroupReadMark.last_read_message_id >= message.id)
+        connection.execute(update(summaries).where(
+            summaries.c.chat_type == GROUP, summaries.c.chat_id == message.group_id,
+            summaries.c.user_id != message.sender_id, summaries.c.user_id.not_in(readers),
+            summaries.c.unread_count > 0,
+        ).values(unread_count=summaries.c.unread_count - 1))
+
+
+def _is_read_changed(obj) -> bool:
+    return inspect(obj).attrs.is_read.history.has_changes()
+
+
+@event.listens_for(Session, "after_flush")
+def _after_flush(session: Session, flush_context):
+    new_direct = [obj for obj in session.new if isinstance(obj, Message) and obj.receiver_id is not None]
+    new_group = [obj for obj in session.new if isinstance(obj, GroupMessage) and obj.group_id is not None]
+    new_groups = [obj for obj in session.new if isinstance(obj, Group)]
+    removed_group = [obj for obj in session.deleted if isinstance(obj, GroupMessage) and obj.group_id is not None]
+    # Direct chats whose rows need recomputing: deleted messages and messages marked read
+    stale_direct = {
+        tuple(sorted((obj.sender_id, obj.receiver_id)))
+        for obj in list(session.deleted) + list(session.dirty)
+        if isinstance(obj, Message) and obj.receiver_id is not None
+        and (obj in session.deleted or _is_read_changed(obj))
+    }
+    if not (new_direct or new_group or new_groups or removed_group or stale_direct):
+        return
+
+    connection = session.connection()
+    if new_groups:
+        _add_groups(connection, new_groups)
+    if new_direct:
+        _add_direct(connection, new_direct)
+    if new_group:
+        _add_group(connection, new_group)
+    if removed_group:
+        _uncount_group_messages(connection, removed_group)
+    for group_id in {obj.group_id for obj in removed_group}:
+        _refresh_group_last(connection, group_id)
+    for user_a, user_b in stale_direct:
+        refresh_direct(connection, user_a, user_b)
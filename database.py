@@ -1,9 +1,12 @@
 # In C:\Users\abdul\Desktop\fastapi\fastapi\netcom\app\database.py
 
+import asyncio
 import os
-from sqlalchemy import create_engine
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Select, create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 # Define the absolute path to your database file
 # This is the most robust way to ensure it always points to the same place.
@@ -15,13 +18,97 @@ DATABASE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "n
 # The triple slash after sqlite: indicates an absolute path for SQLite
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DATABASE_FILE_PATH}"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Production profile, applied to every connection as it is opened.
+# WAL lets readers run while a write is in progress; NORMAL only fsyncs at checkpoints
+# (a power cut can lose the last commits, never corrupt the file); busy_timeout makes a
+# blocked connection wait instead of failing straight away with "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,  # ms
+    "cache_size": -64000,  # Negative = KiB, so 64 MB of page cache per connection
+    "mmap_size": 268435456,  # 256 MB memory-mapped reads
+    "temp_store": "MEMORY",
+}
+# Readers are plain WAL connections that refuse to write. READ_POOL_SIZE stay open; beyond
+# that extra ones are opened on demand (-1 = no cap), because one request can hold two
+# sessions at once (get_current_user's and the route's) and a hard cap could deadlock.
+READ_POOL_SIZE = 8
+READ_POOL_OVERFLOW = -1
+
+
+def create_sqlite_engine(url: str, readonly: bool = False, **kwargs):
+    """
+    Engine with SQLITE_PRAGMAS applied on connect. The writer engine has exactly one connection,
+    so writers queue for it in the pool instead of fighting over SQLite's lock; readonly engines
+    get a pool of query_only connections.
+    """
+    if readonly:
+        kwargs.setdefault("pool_size", READ_POOL_SIZE)
+        kwargs.setdefault("max_overflow", READ_POOL_OVERFLOW)
+    else:
+        kwargs.setdefault("pool_size", 1)
+        kwargs.setdefault("max_overflow", 0)
+    new_engine = create_engine(url, connect_args={"check_same_thread": False}, poolclass=QueuePool, **kwargs)
+
+    @event.listens_for(new_engine, "connect")
+    def _apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        if readonly:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+    return new_engine
+
+
+# engine is the single writer (create_all, migrations, ingest and every flush/UPDATE use it)
+engine = create_sqlite_engine(SQLALCHEMY_DATABASE_URL)
+read_engine = create_sqlite_engine(SQLALCHEMY_DATABASE_URL, readonly=True)
+
+
+class RoutingSession(Session):
+    """
+    Plain SELECTs go to the reader pool, everything else (flushes, UPDATE/DELETE/INSERT, raw
+    SQL) to the writer. Once a transaction has written, it keeps reading from the writer so it
+    sees its own uncommitted changes.
+    """
+
+    _uses_writer = False
+
+    def __init__(self, writer=None, reader=None, **kwargs):
+        super().__init__(**kwargs)
+        self.writer = writer or engine
+        self.reader = reader or read_engine
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._uses_writer or self._flushing or not isinstance(clause, Select):
+            self._uses_writer = True
+            return self.writer
+        return self.reader
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _back_to_readers(session, transaction):
+    if transaction.parent is None:
+        session._uses_writer = False
+
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, class_=RoutingSession)
 
 Base = declarative_base()
 
+# Blocking DB calls made from async code (the WebSocket path, presence, background tasks) run
+# here instead of on the event loop, so a slow commit/fsync doesn't stall every socket.
+# SQLite only has one writer at a time, so a single thread serializes writes without lock waits.
+DB_THREADS = 1
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+async def run_in_db_thread(fn, *args):
+    """Run fn(*args) on the DB thread and wait for the result without blocking the loop."""
+    return await asyncio.get_running_loop().run_in_executor(db_executor, fn, *args)
+
 def get_db():
     db = SessionLocal()
     try:
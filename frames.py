@@ -0,0 +1,190 @@
+# In frames.py
+#
+# Outbound WebSocket frames. A Frame wraps one payload dict and encodes it the first time a
+# socket needs it, so a group or broadcast fan-out serializes the payload once instead of
+# once per recipient. Sequenced copies (one per recipient, see sequenced()) splice their
+# "seq" into that shared encoding instead of serializing the payload again.
+#
+# Two wire formats are spoken:
+#   - JSON text frames (default, what older Flutter clients expect)
+#   - MessagePack binary frames, when the client asks for the "msgpack" subprotocol. These use
+#     the short keys and type codes below, which is where most of the size saving comes from.
+
+import json
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import orjson  # Much faster than the stdlib encoder; optional
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack  # Optional; without it every client gets JSON
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+# Long key -> short key on msgpack frames (both directions). Keys not listed go as they are.
+COMPACT_KEYS = {
+    "type": "t",
+    "seq": "q",
+    "id": "i",
+    "from": "f",
+    "to": "o",
+    "content": "c",
+    "timestamp": "ts",
+    "file_path": "fp",
+    "file_type": "ft",
+    "file_name": "fn",
+    "is_group": "ig",
+    "forwarded_from": "ff",
+    "group": "g",
+    "message": "m",
+    "message_id": "mi",
+    "status": "st",
+    "username": "u",
+    "changes": "ch",
+    "chat_type": "ct",
+    "chat_id": "ci",
+    "last_message": "lm",
+    "unread_count": "uc",
+    "epoch": "e",
+    "replayed": "r",
+    "error": "er",
+}
+EXPANDED_KEYS = {short: key for key, short in COMPACT_KEYS.items()}
+
+# "type" values on msgpack frames. Append only: clients hard-code these numbers.
+TYPE_CODES = {
+    "direct_message": 1,
+    "group_message": 2,
+    "broadcast": 3,
+    "message_status": 4,
+    "chat_preview_update": 5,
+    "presence_diff": 6,
+    "notice_post": 7,
+    "heartbeat": 8,
+    "session": 9,
+    "resync": 10,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+
+def dumps(payload: Dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload).decode("utf-8")
+    # Same settings starlette's send_json uses
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+def compact(value: Any) -> Any:
+    """Rewrite a payload with short keys and numeric types for the msgpack protocol."""
+    if isinstance(value, dict):
+        out = {}
+        for key, item in value.items():
+            if key == "type":
+                out[COMPACT_KEYS["type"]] = TYPE_CODES.get(item, item)
+            else:
+                out[COMPACT_KEYS.get(key, key)] = compact(item)
+        return out
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    return value
+
+
+def expand(value: Any) -> Any:
+    """Inverse of compact(), for frames received from msgpack clients."""
+    if isinstance(value, dict):
+        out = {}
+        for key, item in value.items():
+            key = EXPANDED_KEYS.get(key, key)
+            out[key] = TYPE_NAMES.get(item, item) if key == "type" else expand(item)
+        return out
+    if isinstance(value, list):
+        return [expand(item) for item in value]
+    return value
+
+
+def packb(payload: Dict) -> bytes:
+    # datetimes etc. are sent as strings, as in the JSON frames
+    return msgpack.packb(compact(payload), default=str)
+
+
+def unpackb(data: bytes) -> Dict:
+    return expand(msgpack.unpackb(data))
+
+
+def negotiate(requested: List[str]) -> Optional[str]:
+    """Pick the subprotocol to accept from the client's list; None means plain JSON."""
+    if MSGPACK in requested and msgpack is not None:
+        return MSGPACK
+    if JSON in requested:
+        return JSON
+    return None
+
+
+def _map_header(size: int) -> bytes:
+    if size < 16:
+        return bytes([0x80 | size])
+    if size < 0x10000:
+        return b"\xde" + size.to_bytes(2, "big")
+    return b"\xdf" + size.to_bytes(4, "big")
+
+
+def _splice_seq(seq: int, packed: bytes) -> bytes:
+    """Add a seq entry to an already packed msgpack map."""
+    first = packed[0]
+    if first & 0xf0 == 0x80:
+        size, body = first & 0x0f, packed[1:]
+    elif first == 0xde:
+        size, body = int.from_bytes(packed[1:3], "big"), packed[3:]
+    else:
+        size, body = int.from_bytes(packed[1:5], "big"), packed[5:]
+    return _map_header(size + 1) + msgpack.packb(COMPACT_KEYS["seq"]) + msgpack.packb(seq) + body
+
+
+class Frame:
+    """A payload that is encoded at most once per wire format, however many sockets it is sent to."""
+
+    __slots__ = ("payload", "seq", "_base", "_text", "_packed")
+
+    # Total number of encodes, reported by ConnectionManager.get_stats()
+    encodes = 0
+
+    def __init__(self, payload: Dict, seq: Optional[int] = None, base: Optional["Frame"] = None):
+        self.payload = payload  # Without the seq; that only exists in the encoded forms
+        self.seq = seq
+        self._base = base
+        self._text = None
+        self._packed = None
+
+    def sequenced(self, seq: int) -> "Frame":
+        """The same payload carrying a per-recipient "seq", sharing this frame's encoding."""
+        return Frame(self.payload, seq, self)
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            if self._base is not None:
+                body = self._base.text[1:]
+                self._text = '{"seq":%d%s%s' % (self.seq, "" if body == "}" else ",", body)
+            else:
+                self._text = dumps(self.payload)
+                Frame.encodes += 1
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        if self._packed is None:
+            if self._base is not None:
+                self._packed = _splice_seq(self.seq, self._base.packed)
+            else:
+                self._packed = packb(self.payload)
+                Frame.encodes += 1
+        return self._packed
+
+
+def as_frame(message: Union[Dict, Frame]) -> Frame:
+    return message if isinstance(message, Frame) else Frame(message)
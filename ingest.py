@@ -0,0 +1,133 @@
+# In ingest.py
+#
+# Group commit for chat messages. Instead of one INSERT + COMMIT (and one fsync) per message,
+# Message/GroupMessage rows are buffered for a few milliseconds, or until INGEST_MAX_BATCH rows
+# are waiting, and written in one transaction. Every sender awaits its own row and gets the
+# assigned id back once the batch has been committed.
+
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import sessionmaker
+
+from app.database import engine, run_in_db_thread
+
+# How long the first row of a batch may wait for company, e.g. NETCONNECT_INGEST_FLUSH_MS=2
+INGEST_FLUSH_SECONDS = float(os.environ.get("NETCONNECT_INGEST_FLUSH_MS", "5")) / 1000
+# A batch this large is written straight away
+INGEST_MAX_BATCH = 256
+
+# Rows stay readable after the commit (id, timestamp...) without a refresh query per row
+IngestSession = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+
+class MessageIngestor:
+    """Buffers new message rows and commits them in batches on the DB thread."""
+
+    def __init__(self, session_factory=IngestSession, flush_window: float = INGEST_FLUSH_SECONDS,
+                 max_batch: int = INGEST_MAX_BATCH):
+        self.session_factory = session_factory
+        self.flush_window = flush_window
+        self.max_batch = max_batch
+        self._pending: List[Tuple[object, asyncio.Future]] = []
+        self._full: Optional[asyncio.Event] = None  # Created with the task, on the running loop
+        self._task: Optional[asyncio.Task] = None
+        # Counters
+        self.rows = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.failed_batches = 0
+        self.failed_rows = 0
+
+    async def add(self, row) -> int:
+        """Queue one new row and wait until it is committed. Returns its id."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        if self._task is None or self._task.done():
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def _run(self):
+        while self._pending:
+            if len(self._pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_window)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            # Rows arriving while this commit runs make up the next batch
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[object, asyncio.Future]]):
+        rows = [row for row, _ in batch]
+        try:
+            await run_in_db_thread(self._commit, rows)
+            errors = [None] * len(rows)
+        except Exception as e:
+            self.failed_batches += 1
+            print(f"Error committing batch of {len(rows)} messages, retrying them one by one: {e}")
+            # The batch was rolled back; one bad row must not fail everybody else's message
+            errors = await run_in_db_thread(self._commit_each, rows)
+        committed = errors.count(None)
+        self.rows += committed
+        self.failed_rows += len(rows) - committed
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(rows))
+        for (row, future), error in zip(batch, errors):
+            if future.done():  # The sender may have gone away meanwhile
+                continue
+            if error is None:
+                future.set_result(row.id)
+            else:
+                future.set_exception(error)
+
+    def _commit(self, rows: List[object]):
+        db = self.session_factory()
+        try:
+            db.add_all(rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _commit_each(self, rows: List[object]) -> List[Optional[Exception]]:
+        """Commit rows one per transaction; returns each row's error, or None if it was stored."""
+        errors = []
+        for row in rows:
+            try:
+                self._commit([row])
+                errors.append(None)
+            except Exception as e:
+                print(f"Error committing message: {e}")
+                errors.append(e)
+        return errors
+
+    async def drain(self):
+        """Commit whatever is still buffered (used at shutdown)."""
+        if self._task is not None and not self._task.done():
+            self._full.set()
+            await self._task
+
+    def stats(self) -> Dict:
+        return {
+            "flush_window_ms": self.flush_window * 1000,
+            "max_batch": self.max_batch,
+            "pending": len(self._pending),
+            "rows": self.rows,
+            "batches": self.batches,
+            "avg_batch": round(self.rows / self.batches, 2) if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "failed_batches": self.failed_batches,
+            "failed_rows": self.failed_rows,
+        }
+
+
+ingestor = MessageIngestor()
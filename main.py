@@ -1,14 +1,17 @@
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
-from app.database import Base, engine, SessionLocal
+from app.database import Base, engine, SessionLocal, run_in_db_thread
 from app.models import User  # Import your User model for the background task
 from app.websocket_manager import manager  # Import WebSocket manager
+from app.ingest import ingestor  # Batched (group commit) message inserts
+from app.presence import presence_store, sweep_inactive  # In-memory presence, flushed to the users table in batches
 from app.routes import users, messages, groups, files, websocket, notice_board  # ✅ import all route modules here
 from fastapi.middleware.cors import CORSMiddleware
 from app.authj import jwt_handler  # Import JWT handler for authentication
 import uvicorn
 import socket
 import asyncio
+import time
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
@@ -17,44 +20,52 @@ from sqlalchemy.orm import Session
 # Define the background task for status cleanup
 async def background_status_cleanup(db_session_factory, interval_seconds=60, inactive_threshold_minutes=5):
     """
-    Periodically checks users' last_active_at timestamp.
-    If a user is marked online but has been inactive for longer than inactive_threshold_minutes,
-    they are marked offline in the database and their status is broadcast.
+    Periodically marks users offline who are flagged online but have been inactive for longer
+    than inactive_threshold_minutes. Each run is one bulk UPDATE ... RETURNING plus one batched
+    presence notification, however many users time out at once. Users with a live socket on
+    any worker are skipped; dead sockets are the heartbeat's job.
     """
     print("Starting background status cleanup task...")
     while True:
         await asyncio.sleep(interval_seconds) # Wait for the specified interval before checking again
-        
-        # Get a new database session for this task's operation
-        # This is crucial for long-running background tasks to avoid session staleness.
-        db: Session = db_session_factory()
+        started = time.perf_counter()
+
+        # Write pending heartbeats first so last_active_at in the DB is current
+        await presence_store.flush_async(db_session_factory)
+
+        # All timestamps should ideally be UTC for consistency
+        threshold_time = datetime.utcnow() - timedelta(minutes=inactive_threshold_minutes)
+        connected = list(manager.presence_devices)
+
+        def sweep():
+            # Get a new database session for this run (long-lived sessions go stale)
+            db: Session = db_session_factory()
+            try:
+                return sweep_inactive(db, threshold_time, connected)
+            except Exception:
+                db.rollback() # Rollback any changes if an error occurred in this run
+                raise
+            finally:
+                # Always close the database session
+                db.close()
+
         try:
-            # Define the threshold for inactivity
-            # All timestamps should ideally be UTC for consistency
-            threshold_time = datetime.utcnow() - timedelta(minutes=inactive_threshold_minutes)
-
-            # Query for users who are currently online but haven't been active recently
-            stale_users = db.query(User).filter(
-                User.is_online == True,
-                User.last_active_at < threshold_time
-            ).all()
-
-            for user in stale_users:
-                user.is_online = False # Mark them offline
-                db.commit() # Commit changes for this user (or you can batch commits)
-                print(f"User {user.username} marked offline due to inactivity (last active: {user.last_active_at.strftime('%Y-%m-%d %H:%M:%S UTC')}).")
-                
-                # Broadcast this status change to all other active WebSocket clients
-                # Use asyncio.create_task to not block the cleanup loop while broadcasting
-                asyncio.create_task(manager.broadcast_status(user.username, "offline", exclude=None))
-            
+            stale_usernames = await run_in_db_thread(sweep)
+            # One event for everybody; the DB is already up to date
+            await manager.broadcast_statuses([(username, "offline") for username in stale_usernames], persist=False)
         except Exception as e:
             # Log any errors that occur during the cleanup process
             print(f"Error in background_status_cleanup: {e}")
-            db.rollback() # Rollback any changes if an error occurred in the current iteration
-        finally:
-            # Always close the database session
-            db.close()
+            continue
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        presence_store.last_sweep = {
+            "at": datetime.utcnow().isoformat(),
+            "marked_offline": len(stale_usernames),
+            "duration_ms": round(elapsed_ms, 2),
+        }
+        if stale_usernames:
+            print(f"Status sweep: {len(stale_usernames)} users marked offline due to inactivity in {elapsed_ms:.1f} ms.")
 
 # Lifespan context manager for startup/shutdown events of the FastAPI application
 @asynccontextmanager
@@ -65,6 +76,12 @@ async def lifespan(app: FastAPI):
     ip = get_local_ip()
     print(f"Server is running on IP: {ip}")
 
+    # Connect the WebSocket manager to the backplane shared with the other workers
+    await manager.start()
+
+    # Write presence (is_online / last_active_at) back to the DB in periodic batches
+    presence_flusher = asyncio.create_task(presence_store.run_flusher(SessionLocal))
+
     # Start the background status cleanup task
     asyncio.create_task(background_status_cleanup(
         db_session_factory=SessionLocal,
@@ -75,6 +92,10 @@ async def lifespan(app: FastAPI):
     yield
 
     print("Application shutting down...")
+    await manager.stop()
+    await ingestor.drain() # Commit messages still waiting for their batch
+    presence_flusher.cancel()
+    await presence_store.flush_async(SessionLocal) # Don't lose the last few seconds of presence
 
 
 # Initialize FastAPI app
@@ -1,4 +1,4 @@
-from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, Text, Boolean, UniqueConstraint, func
+from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, Text, Boolean, UniqueConstraint, Index, event, func
 from sqlalchemy.orm import relationship, backref
 from datetime import datetime
 from .database import Base
@@ -42,16 +42,43 @@ class Message(Base):
     forwarded_from_content = Column(Text, nullable=True)
     forwarded_from_sender = Column(String, nullable=True)
     forwarded_from_timestamp = Column(DateTime, nullable=True)
+    # Same value for both directions of a direct chat (see conversation_key); null for broadcasts
+    conversation_id = Column(String, nullable=True)
 
     sender = relationship("User", back_populates="messages_sent", foreign_keys=[sender_id])
     receiver = relationship("User", back_populates="messages_received", foreign_keys=[receiver_id])
     # forwarded_from = relationship("Message", remote_side=[id], uselist=False)  # Optional: for ORM access
 
+    __table_args__ = (
+        # Conversation history (sender, receiver) ordered by time; also the sender_id lookups
+        Index('ix_messages_sender_receiver_timestamp', 'sender_id', 'receiver_id', 'timestamp'),
+        # Incoming messages and unread counts (receiver, sender, is_read)
+        Index('ix_messages_receiver_sender_is_read', 'receiver_id', 'sender_id', 'is_read'),
+        # Direct-chat history and last message: one range of one index
+        Index('ix_messages_conversation_timestamp', 'conversation_id', 'timestamp'),
+        # Keyset paging of a conversation by id
+        Index('ix_messages_conversation_id', 'conversation_id', 'id'),
+    )
+
+
+def conversation_key(user_id_a: int, user_id_b: int) -> str:
+    """Canonical id of the direct chat between two users, e.g. "3:17" either way round."""
+    low, high = sorted((user_id_a, user_id_b))
+    return f"{low}:{high}"
+
+
+@event.listens_for(Message, "before_insert")
+def _set_conversation_id(mapper, connection, message):
+    if message.conversation_id is None and message.receiver_id is not None:
+        message.conversation_id = conversation_key(message.sender_id, message.receiver_id)
+
 user_group = Table(
     'user_group',
     Base.metadata,
     Column('user_id', Integer, ForeignKey('users.id')),
-    Column('group_id', Integer, ForeignKey('groups.id'))
+    Column('group_id', Integer, ForeignKey('groups.id')),
+    Index('ix_user_group_group_user', 'group_id', 'user_id'),  # Members of a group
+    Index('ix_user_group_user_group', 'user_id', 'group_id'),  # Groups of a user
 )
 
 class Group(Base):
@@ -84,18 +111,58 @@ class GroupMessage(Base):
     sender = relationship("User")
     # forwarded_from = relationship("GroupMessage", remote_side=[id], uselist=False)  # Optional: for ORM access
 
-class GroupMessageRead(Base):
-    __tablename__ = 'group_message_reads'
+    __table_args__ = (
+        Index('ix_group_messages_group_timestamp', 'group_id', 'timestamp'),  # Group history and previews
+        Index('ix_group_messages_group_id', 'group_id', 'id'),  # Keyset paging of group history
+    )
+
+class GroupReadMark(Base):
+    """How far a member has read a group: every message with id <= last_read_message_id is read."""
+    __tablename__ = 'group_read_marks'
 
     id = Column(Integer, primary_key=True, index=True)
-    group_message_id = Column(Integer, ForeignKey('group_messages.id'))
-    user_id = Column(Integer, ForeignKey('users.id'))
-    is_read = Column(Boolean, default=False)  # 0 for unread, 1 for read
+    group_id = Column(Integer, ForeignKey('groups.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('group_id', 'user_id', name='unique_group_read_mark'),  # One watermark per member
+        Index('ix_group_read_marks_group_last_read', 'group_id', 'last_read_message_id'),  # "Seen by"
+    )
+
+class ChatSummary(Base):
+    """One /chats entry per user and chat, kept current by app.chat_summaries on every flush."""
+    __tablename__ = 'chat_summaries'
 
-    group_message = relationship("GroupMessage", backref="reads")
-    user = relationship("User", backref="group_message_reads")
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    chat_type = Column(String, nullable=False)  # 'direct' or 'group'
+    chat_id = Column(Integer, nullable=False)  # Peer user id or group id
+    last_message_id = Column(Integer, nullable=True)
+    last_message = Column(Text, nullable=True)  # Preview text as shown in the chat list
+    last_sender_id = Column(Integer, nullable=True)
+    last_is_read = Column(Boolean, nullable=True)  # Direct chats only: drives "sent"/"seen"
+    last_ts = Column(DateTime, nullable=True)
+    unread_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'chat_type', 'chat_id', name='unique_chat_summary'),
+        Index('ix_chat_summaries_user_last_ts', 'user_id', 'last_ts'),  # The /chats read, newest first
+        Index('ix_chat_summaries_chat', 'chat_type', 'chat_id'),  # All members' rows of a group
+    )
 
-    __table_args__ = (UniqueConstraint('group_message_id', 'user_id', name='unique_group_message_read'),)  # Ensure one read per user per message
+class UserSession(Base):
+    """A login: its refresh token rotates on every use; access tokens carry its id as "sid"."""
+    __tablename__ = 'user_sessions'
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    refresh_token_hash = Column(String, nullable=False)  # sha256 of the current refresh token's secret
+    previous_token_hash = Column(String, nullable=True)  # The one it replaced, to spot reuse
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime, nullable=True)
 
 
 notice_board_follower = Table(
@@ -0,0 +1,259 @@
+# In presence.py
+#
+# Presence fan-out and state. Status changes are only sent to users who share a direct
+# conversation or a group with the subject, and they are coalesced into one "presence_diff"
+# frame per watcher every PRESENCE_WINDOW_SECONDS instead of one frame per change per socket.
+# PresenceStore keeps is_online / last_active_at in memory and writes them back in batches.
+
+import asyncio
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import DateTime, bindparam, text, update
+from sqlalchemy.orm import Session
+
+from app.database import run_in_db_thread
+from app.models import User
+
+PRESENCE_WINDOW_SECONDS = 0.25  # Changes inside one window go out as a single diff
+OFFLINE_GRACE_SECONDS = 3.0  # Debounce: "offline" is only announced if the user stays away this long
+INTEREST_CACHE_SECONDS = 30  # How long a subject's watcher list is reused before re-querying
+PRESENCE_FLUSH_SECONDS = 5  # How often dirty presence rows are written back to the users table
+
+# Everyone a user has a direct conversation with, plus everyone they share a group with.
+# Returns (subject, watcher) username pairs. The distinct (subject id, peer id) pairs come
+# straight off the (sender_id, receiver_id) and (receiver_id, sender_id) indexes, so users is
+# only joined onto one row per pair, not onto every message the subject ever sent or received.
+_INTEREST_SQL = text("""
+WITH subject_ids AS (SELECT id FROM users WHERE username IN :subjects),
+pairs AS (
+    SELECT DISTINCT sender_id AS subject_id, receiver_id AS peer_id FROM messages
+        WHERE sender_id IN (SELECT id FROM subject_ids) AND receiver_id IS NOT NULL
+    UNION
+    SELECT DISTINCT receiver_id, sender_id FROM messages
+        WHERE receiver_id IN (SELECT id FROM subject_ids)
+    UNION
+    SELECT a.user_id, b.user_id FROM user_group a
+        JOIN user_group b ON b.group_id = a.group_id AND b.user_id != a.user_id
+        WHERE a.user_id IN (SELECT id FROM subject_ids)
+)
+SELECT su.username, pu.username FROM pairs
+    JOIN users su ON su.id = pairs.subject_id
+    JOIN users pu ON pu.id = pairs.peer_id
+""").bindparams(bindparam("subjects", expanding=True))
+
+
+def load_interest(db: Session, subjects: List[str]) -> Dict[str, Set[str]]:
+    """Map each subject username to the usernames that should see its presence."""
+    watchers: Dict[str, Set[str]] = {subject: set() for subject in subjects}
+    if not subjects:
+        return watchers
+    for subject, watcher in db.execute(_INTEREST_SQL, {"subjects": list(subjects)}):
+        if watcher != subject:
+            watchers[subject].add(watcher)
+    return watchers
+
+
+class PresenceCoalescer:
+    """
+    Collects status changes and flushes them as batched diffs.
+
+    - Changes that land in the same window become one frame per watcher.
+    - Going offline waits OFFLINE_GRACE_SECONDS; if the user comes back first (a Wi-Fi blip,
+      an app restart) nothing is sent at all, so flapping users don't spam their contacts.
+    - A change that leaves the user where watchers last saw them is dropped.
+    """
+
+    def __init__(self,
+                 lookup_watchers: Callable[[List[str]], Awaitable[Dict[str, Set[str]]]],
+                 send: Callable[[str, Dict], None],
+                 window: float = PRESENCE_WINDOW_SECONDS,
+                 offline_grace: float = OFFLINE_GRACE_SECONDS):
+        self.lookup_watchers = lookup_watchers
+        self.send = send
+        self.window = window
+        self.offline_grace = offline_grace
+        self._pending: Dict[str, Tuple[str, float]] = {}  # username -> (status, due time)
+        self._announced: Dict[str, str] = {}  # username -> status watchers were last told
+        self._task: Optional[asyncio.Task] = None
+        # Counters
+        self.changes_received = 0
+        self.changes_suppressed = 0
+        self.frames_sent = 0
+
+    def update(self, username: str, status: str):
+        self.changes_received += 1
+        delay = self.offline_grace if status == "offline" else 0
+        self._pending[username] = (status, time.monotonic() + delay)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(self.window)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing presence changes: {e}")
+
+    async def flush(self):
+        now = time.monotonic()
+        changes = []
+        for username, (status, due) in list(self._pending.items()):
+            if due > now:
+                continue
+            del self._pending[username]
+            if self._announced.get(username) == status:
+                self.changes_suppressed += 1
+                continue
+            self._announced[username] = status
+            changes.append((username, status))
+        if not changes:
+            return
+
+        watchers = await self.lookup_watchers([username for username, _ in changes])
+        diffs: Dict[str, List[Dict]] = {}
+        for username, status in changes:
+            for watcher in watchers.get(username, ()):
+                diffs.setdefault(watcher, []).append({"username": username, "status": status})
+        for watcher, diff in diffs.items():
+            self.send(watcher, {"type": "presence_diff", "changes": diff})
+            self.frames_sent += 1
+
+    def stats(self) -> Dict:
+        return {
+            "pending": len(self._pending),
+            "changes_received": self.changes_received,
+            "changes_suppressed": self.changes_suppressed,
+            "diff_frames_sent": self.frames_sent,
+        }
+
+
+# One statement, executed with many parameter sets per flush
+_FLUSH_SQL = text(
+    "UPDATE users SET is_online = :is_online, last_active_at = :last_active_at WHERE username = :username"
+).bindparams(bindparam("last_active_at", type_=DateTime()))  # Same storage format as the ORM column
+
+
+class PresenceStore:
+    """
+    In-memory is_online / last_active_at per user. While the process is up this is the
+    authoritative copy: heartbeats and connects only touch memory, and dirty rows are
+    written back to the users table in one batched UPDATE every PRESENCE_FLUSH_SECONDS.
+    """
+
+    def __init__(self, flush_interval: float = PRESENCE_FLUSH_SECONDS):
+        self.flush_interval = flush_interval
+        self._entries: Dict[str, List] = {}  # username -> [is_online, last_active_at]
+        self._dirty: Set[str] = set()
+        # Counters
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.last_sweep: Dict = {}
+
+    def set_online(self, username: str, is_online: bool, persist: bool = True):
+        """Record a status change. persist=False for changes another worker is writing back."""
+        self._entries[username] = [is_online, datetime.utcnow()]
+        if persist:
+            self._dirty.add(username)
+
+    def touch(self, username: str):
+        """The user did something (heartbeat, message): bump last_active_at only."""
+        entry = self._entries.get(username)
+        if entry is None:
+            self._entries[username] = [True, datetime.utcnow()]
+        else:
+            entry[1] = datetime.utcnow()
+        self._dirty.add(username)
+
+    def get(self, username: str) -> Optional[Tuple[bool, datetime]]:
+        entry = self._entries.get(username)
+        return (entry[0], entry[1]) if entry else None
+
+    def is_online(self, username: str, default: bool = False) -> bool:
+        """Our view if we have one, otherwise whatever the caller read from the DB."""
+        entry = self._entries.get(username)
+        return entry[0] if entry else bool(default)
+
+    def _take_dirty(self) -> List[Dict]:
+        dirty, self._dirty = self._dirty, set()
+        return [
+            {"username": username, "is_online": self._entries[username][0],
+             "last_active_at": self._entries[username][1]}
+            for username in dirty
+        ]
+
+    def _write(self, db: Session, rows: List[Dict]):
+        db.execute(_FLUSH_SQL, rows)
+        db.commit()
+        self.flushes += 1
+        self.rows_flushed += len(rows)
+
+    def flush(self, db: Session) -> int:
+        """Write every dirty entry back in a single executemany UPDATE. Returns rows written."""
+        rows = self._take_dirty()
+        if rows:
+            self._write(db, rows)
+        return len(rows)
+
+    async def run_flusher(self, db_session_factory):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_async(db_session_factory)
+
+    async def flush_async(self, db_session_factory) -> int:
+        """Snapshot dirty rows on the event loop, write them from the DB thread."""
+        rows = self._take_dirty()
+        if not rows:
+            return 0
+
+        def _flush():
+            db = db_session_factory()
+            try:
+                self._write(db, rows)
+            finally:
+                db.close()
+        try:
+            await run_in_db_thread(_flush)
+        except Exception as e:
+            print(f"Error flushing presence: {e}")
+            self._dirty.update(row["username"] for row in rows)  # Try again next time
+            return 0
+        return len(rows)
+
+    def stats(self) -> Dict:
+        return {
+            "tracked_users": len(self._entries),
+            "dirty": len(self._dirty),
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+            "last_sweep": self.last_sweep,
+        }
+
+
+def sweep_inactive(db: Session, threshold: datetime, connected: List[str]) -> List[str]:
+    """
+    Mark everyone offline who is still flagged online, hasn't been active since `threshold`
+    and has no live socket, in one UPDATE ... RETURNING. Returns their usernames.
+    """
+    statement = (
+        update(User)
+        .where(User.is_online == True, User.last_active_at < threshold, User.username.not_in(connected))
+        # Keep last_active_at as it was (the column's onupdate would otherwise stamp "now")
+        .values(is_online=False, last_active_at=User.last_active_at)
+        .returning(User.username)
+        .execution_options(synchronize_session=False)
+    )
+    usernames = [username for (username,) in db.execute(statement)]
+    db.commit()
+    return usernames
+
+
+presence_store = PresenceStore()
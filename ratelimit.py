@@ -0,0 +1,117 @@
+# In ratelimit.py
+#
+# In-memory token buckets. A bucket holds up to `burst` tokens and refills at `rate` tokens per
+# second; each request takes one, and a request that finds the bucket empty is turned away.
+# The bcrypt-bound auth routes call limit_auth_request() before doing anything else, so a
+# script hammering /login gets a cheap 429 instead of pinning every core with hashes. Buckets
+# are per worker: with several workers a client gets up to that many times the budget.
+
+import math
+import threading
+import time
+from typing import Dict, Optional
+
+from fastapi import HTTPException, Request
+
+# Per client IP address, across all auth routes: 30 attempts at once, then one every 2 seconds
+AUTH_IP_BURST = 30
+AUTH_IP_RATE = 0.5
+# Per username (the account being logged into, signed up or reset): 5, then one every 12 seconds
+AUTH_USERNAME_BURST = 5
+AUTH_USERNAME_RATE = 1 / 12
+# How often idle buckets are dropped
+EVICT_INTERVAL_SECONDS = 60
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now: Optional[float] = None) -> float:
+        """Take a token: 0 if there was one, else the seconds until there will be."""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class TokenBuckets:
+    """One TokenBucket per key (an IP address, a username), with counters. Thread-safe."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self._next_eviction = time.monotonic() + EVICT_INTERVAL_SECONDS
+        # Counters
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def take(self, key: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_eviction:
+                self._evict(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            wait = bucket.take(now)
+            if wait:
+                self.rejected += 1
+            else:
+                self.allowed += 1
+            return wait
+
+    def _evict(self, now: float):
+        # A bucket that has refilled completely is the same as no bucket at all
+        idle = [key for key, bucket in self._buckets.items() if bucket.full(now)]
+        for key in idle:
+            del self._buckets[key]
+        self.evicted += len(idle)
+        self._next_eviction = now + EVICT_INTERVAL_SECONDS
+
+    def stats(self) -> Dict:
+        return {
+            "rate_per_second": self.rate,
+            "burst": self.burst,
+            "buckets": len(self._buckets),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+        }
+
+
+auth_ip_buckets = TokenBuckets(AUTH_IP_RATE, AUTH_IP_BURST)
+auth_username_buckets = TokenBuckets(AUTH_USERNAME_RATE, AUTH_USERNAME_BURST)
+
+
+def limit_auth_request(request: Request, username: Optional[str] = None):
+    """
+    Call first thing in a bcrypt-bound route. Raises 429 with Retry-After when the client's IP
+    address or the username is out of attempts.
+    """
+    checks = [(auth_ip_buckets, request.client.host if request.client else "unknown")]
+    if username:
+        checks.append((auth_username_buckets, username))
+    for buckets, key in checks:
+        wait = buckets.take(key)
+        if wait:
+            raise HTTPException(status_code=429, detail="Too many attempts, try again later",
+                                headers={"Retry-After": str(math.ceil(wait))})
+
+
+def auth_rate_limit_stats() -> Dict:
+    return {"ip": auth_ip_buckets.stats(), "username": auth_username_buckets.stats()}
@@ -67,4 +67,6 @@ def get_my_groups(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    return {"groups": [g.name for g in current_user.groups]}
\ No newline at end of file
+    # current_user is a detached principal without relationships; query the memberships directly
+    names = db.query(Group.name).join(Group.members).filter(User.id == current_user.id).all()
+    return {"groups": [name for (name,) in names]}
\ No newline at end of file
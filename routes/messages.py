@@ -1,17 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, File, status
+from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, File, Query, status
+from sqlalchemy import and_, func
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
-from app.models import User, Message, Group, GroupMessage, GroupMessageRead
+from app.models import User, Message, Group, GroupMessage, GroupReadMark, ChatSummary, conversation_key
+from app.chat_summaries import DIRECT, GROUP, advance_read_mark, group_unread_counts, refresh_direct, unread_count
 from datetime import datetime, timedelta, timezone
 from app.authj.dependencies import get_current_user
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 import os
+from collections import defaultdict
+from typing import Dict, List
 from app.websocket_manager import manager
+from app.ingest import ingestor
+from app.frames import dumps
 
 router = APIRouter()
 
 WAT = timezone(timedelta(hours=1))  
 
+# History paging: ?limit=N returns the newest N messages, ?before_id=<oldest id seen> walks back,
+# ?after_id=<newest id seen> catches up. With none of them the whole history is returned, as before.
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+# Rows read per query when a whole history is streamed (?stream=true)
+HISTORY_STREAM_BATCH = 500
+
 # DB dependency
 def get_db():
     db = SessionLocal()
@@ -20,6 +33,53 @@ def get_db():
     finally:
         db.close()
 
+def page_history(query, id_column, before_id=None, after_id=None, limit=None):
+    """One keyset page of a history query, oldest first. Returns (rows, has_more)."""
+    limit = limit or HISTORY_PAGE_SIZE
+    if before_id is not None:
+        query = query.filter(id_column < before_id)
+    if after_id is not None:
+        # Catching up: the page right after after_id, has_more means newer messages remain
+        query = query.filter(id_column > after_id)
+        rows = query.order_by(id_column).limit(limit + 1).all()
+        return rows[:limit], len(rows) > limit
+    # Newest page (below before_id, if given), has_more means older messages remain
+    rows = query.order_by(id_column.desc()).limit(limit + 1).all()
+    return rows[:limit][::-1], len(rows) > limit
+
+def page_response(rows, has_more, serialize):
+    messages = [serialize(m) for m in rows]
+    return {
+        "messages": messages,
+        "has_more": has_more,
+        "before_id": messages[0]["id"] if messages else None,  # Cursor for the previous (older) page
+        "after_id": messages[-1]["id"] if messages else None,  # Cursor for the next (newer) page
+    }
+
+def stream_history(query, id_column, serialize):
+    """The whole history as {"messages": [...]}, read and sent HISTORY_STREAM_BATCH rows at a time."""
+    def chunks():
+        yield '{"messages":['
+        last_id, first = None, True
+        while True:
+            batch = query if last_id is None else query.filter(id_column > last_id)
+            rows = batch.order_by(id_column).limit(HISTORY_STREAM_BATCH).all()
+            for row in rows:
+                message = serialize(row)
+                yield ("" if first else ",") + dumps(message)
+                first, last_id = False, message["id"]
+            if len(rows) < HISTORY_STREAM_BATCH:
+                break
+        yield ']}'
+    return StreamingResponse(chunks(), media_type="application/json")
+
+def members_by_unread(members, unread: Dict[int, int]) -> Dict[int, List[str]]:
+    """Member usernames grouped by unread counter, so each distinct preview is sent (and encoded) once."""
+    buckets: Dict[int, List[str]] = defaultdict(list)
+    for member in members:
+        buckets[unread.get(member.id, 0)].append(member.username)
+    return buckets
+
 def extract_forwarded_metadata(original):
     return {
         "forwarded_from_type": "group" if isinstance(original, GroupMessage) else "direct",
@@ -29,16 +89,21 @@ def extract_forwarded_metadata(original):
     }
 
 @router.get("/messages/{username1}/{username2}")
-def get_conversation(username1: str, username2: str, db: Session = Depends(get_db)):
+def get_conversation(
+    username1: str,
+    username2: str,
+    before_id: int = Query(None),
+    after_id: int = Query(None),
+    limit: int = Query(None, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    stream: bool = Query(False),
+    db: Session = Depends(get_db)
+):
     user1 = db.query(User).filter(User.username == username1).first()
     user2 = db.query(User).filter(User.username == username2).first()
     if not user1 or not user2:
         raise HTTPException(status_code=404, detail="User not found")
 
-    messages = db.query(Message).filter(
-        ((Message.sender_id == user1.id) & (Message.receiver_id == user2.id)) |
-        ((Message.sender_id == user2.id) & (Message.receiver_id == user1.id))
-    ).order_by(Message.timestamp).all()
+    history = db.query(Message).filter(Message.conversation_id == conversation_key(user1.id, user2.id))
 
     def serialize(msg: Message):
         forwarded = None
@@ -61,6 +126,11 @@ def get_conversation(username1: str, username2: str, db: Session = Depends(get_d
             "forwarded_from": forwarded
         }
 
+    if before_id is not None or after_id is not None or limit is not None:
+        return page_response(*page_history(history, Message.id, before_id, after_id, limit), serialize)
+    if stream:
+        return stream_history(history, Message.id, serialize)
+    messages = history.order_by(Message.timestamp).all()
     return {"messages": [serialize(m) for m in messages]}
 
 @router.post("/messages/send")
@@ -83,22 +153,18 @@ async def send_message(
         content=content,
         timestamp=datetime.now(WAT)
     )
-    db.add(message)
-    db.commit()
-    db.refresh(message)
+    # Group commit: shares one transaction with other messages sent in the same few ms
+    await ingestor.add(message)
 
-    unread_count = db.query(Message).filter(
-        Message.sender_id == current_user.id,
-        Message.receiver_id == receiver.id,
-        Message.is_read == False
-    ).count()
+    # The receiver's counter for this chat, bumped when the message was committed
+    unread = unread_count(db, receiver.id, DIRECT, current_user.id)
 
     preview = {
         "type": "chat_preview_update",
         "chat_type": "direct",
         "chat_id": receiver.username, 
         "last_message": content,
-        "unread_count": unread_count,
+        "unread_count": unread,
         "timestamp": message.timestamp.astimezone(WAT).isoformat(),
         "is_group": False,
     }    
@@ -114,20 +180,13 @@ async def send_message(
         "timestamp": message.timestamp.astimezone(WAT).isoformat(),
         "isMe": False
     }
-    await manager.send_personal_message(formatted, to_username)
-    await manager.send_personal_message(formatted, current_user.username)
-    await manager.send_personal_message(preview, to_username)
-    await manager.send_personal_message(preview, current_user.username)
-    await manager.send_personal_message({
+    await manager.send_to_users(formatted, [to_username, current_user.username])
+    await manager.send_to_users(preview, [to_username, current_user.username])
+    await manager.send_to_users({
         "type": "message_status",
         "message_id": message.id,
         "status": "sent"
-    }, current_user.username)
-    await manager.send_personal_message({
-        "type": "message_status",
-        "message_id": message.id,
-        "status": "sent"
-    }, to_username)
+    }, [current_user.username, to_username])
     
     return {
         "message": "Message sent successfully",
@@ -140,110 +199,47 @@ def get_user_chats(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
+    # One read of the precomputed rows (see app.chat_summaries), newest chat first
+    rows = db.query(ChatSummary, User, Group.name).outerjoin(
+        User, and_(ChatSummary.chat_type == DIRECT, User.id == ChatSummary.chat_id)
+    ).outerjoin(
+        Group, and_(ChatSummary.chat_type == GROUP, Group.id == ChatSummary.chat_id)
+    ).filter(
+        ChatSummary.user_id == current_user.id
+    ).order_by(ChatSummary.last_ts.desc()).all()
+
     chat_previews = []
-    group_counts = {}
-
-    # --- Direct Chats ---
-    user_ids = db.query(Message.sender_id).filter(Message.receiver_id == current_user.id).union(
-        db.query(Message.receiver_id).filter(Message.sender_id == current_user.id)
-    ).distinct()
-    users = db.query(User).filter(User.id.in_(user_ids)).all()
-    for user in users:
-        last_msg = (
-            db.query(Message)
-            .filter(
-                ((Message.sender_id == current_user.id) & (Message.receiver_id == user.id)) |
-                ((Message.sender_id == user.id) & (Message.receiver_id == current_user.id))
-            )
-            .order_by(Message.timestamp.desc())
-            .first()
-        )
-        unread_count = db.query(Message).filter(
-            Message.sender_id == user.id,
-            Message.receiver_id == current_user.id,
-            Message.is_read == False
-        ).count()
-
-        # --- MODIFIED PREVIEW LOGIC ---
-        if last_msg:
-            if last_msg.file_path:
-                file_name = last_msg.file_path.split("/")[-1]
-                if last_msg.content and last_msg.content.strip():
-                    last_message = f"{file_name}: {last_msg.content.strip()}"
-                else:
-                    last_message = file_name
-            else:
-                last_message = last_msg.content or ""
+    for summary, user, group_name in rows:
+        if summary.chat_type == DIRECT:
+            if user is None:
+                continue
             # Only set status for messages sent by current user
-            if last_msg.sender_id == current_user.id:
-                if last_msg.is_read:
-                    status = "seen"
-                else:
-                    # You can add is_delivered if you track it, else default to "sent"
-                    status = "sent"
+            if summary.last_sender_id == current_user.id:
+                status = "seen" if summary.last_is_read else "sent"
             else:
                 status = None
-        else:
-            last_message = ""
-            status = None
-
-        chat_previews.append({
-            "name": user.name,
-            "username": user.username,
-            "avatar_url": user.avatar_url or "https://via.placeholder.com/50",
-            "last_message": last_message,
-            "time_ago": last_msg.timestamp.astimezone(WAT).isoformat() if last_msg else "",
-            "is_group": False,
-            "is_read": unread_count == 0,
-            "unread_count": unread_count,
-            "status": status  # <-- Add this line
-        })
-
-    # --- Group Chats ---
-    for group in current_user.groups:
-        unread_count = db.query(GroupMessage).filter(
-            GroupMessage.group_id == group.id,
-            GroupMessage.sender_id != current_user.id
-        ).outerjoin(
-            GroupMessageRead,
-            (GroupMessageRead.group_message_id == GroupMessage.id) &
-            (GroupMessageRead.user_id == current_user.id)
-        ).filter(
-            (GroupMessageRead.is_read == False) | (GroupMessageRead.id == None)
-        ).count()
-        group_counts[group.name] = unread_count
-
-        last_msg = (
-            db.query(GroupMessage)
-            .filter(GroupMessage.group_id == group.id)
-            .order_by(GroupMessage.timestamp.desc())
-            .first()
-        )
-        # --- MODIFIED PREVIEW LOGIC FOR GROUPS ---
-        if last_msg:
-            if last_msg.file_path:
-                file_name = last_msg.file_path.split("/")[-1]
-                if last_msg.content and last_msg.content.strip():
-                    last_message = f"{file_name}: {last_msg.content.strip()}"
-                else:
-                    last_message = file_name
-            else:
-                last_message = last_msg.content or ""
-        else:
-            last_message = ""
-        chat_previews.append({
-            "name": group.name,
-            "username": group.name,
-            "avatar_url": getattr(group, "avatar_url", None) or "https://via.placeholder.com/50",
-            "last_message": last_message,
-            "time_ago": last_msg.timestamp.astimezone(WAT).isoformat() if last_msg else "",
-            "is_group": True,
-            "is_read": unread_count == 0,
-            "unread_count": unread_count,
-        })
-
-    # Sort by last message time (descending)
-    chat_previews.sort(key=lambda x: x["time_ago"], reverse=True)
+            chat_previews.append({
+                "name": user.name,
+                "username": user.username,
+                "avatar_url": user.avatar_url or "https://via.placeholder.com/50",
+                "last_message": summary.last_message or "",
+                "time_ago": summary.last_ts.astimezone(WAT).isoformat() if summary.last_ts else "",
+                "is_group": False,
+                "is_read": summary.unread_count == 0,
+                "unread_count": summary.unread_count,
+                "status": status
+            })
+        elif group_name is not None:
+            chat_previews.append({
+                "name": group_name,
+                "username": group_name,
+                "avatar_url": "https://via.placeholder.com/50",
+                "last_message": summary.last_message or "",
+                "time_ago": summary.last_ts.astimezone(WAT).isoformat() if summary.last_ts else "",
+                "is_group": True,
+                "is_read": summary.unread_count == 0,
+                "unread_count": summary.unread_count,
+            })
     return chat_previews
 
 @router.post("/messages/mark_read")
@@ -260,6 +256,8 @@ def mark_direct_read(
         Message.receiver_id == current_user.id,
         Message.is_read == False
     ).update({Message.is_read: True}, synchronize_session=False)
+    # Bulk updates skip the flush hooks, so bring the chat rows up to date here
+    refresh_direct(db.connection(), current_user.id, sender.id)
     db.commit()
     return {"status": "success"}
 
@@ -272,25 +270,29 @@ def mark_group_read(
     group = db.query(Group).filter(Group.name == group_name).first()
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
-    messages = db.query(GroupMessage).filter(
-        GroupMessage.group_id == group.id,
-        GroupMessage.sender_id != current_user.id
-    ).all()
-    for msg in messages:
-        read = db.query(GroupMessageRead).filter_by(
-            group_message_id=msg.id, user_id=current_user.id
-        ).first()
-        if not read:
-            read = GroupMessageRead(
-                group_message_id=msg.id, user_id=current_user.id, is_read=True
-            )
-            db.add(read)
-        else:
-            read.is_read = True
+    # Read state is one watermark per member: move it to the newest message
+    last_id = db.query(func.max(GroupMessage.id)).filter(GroupMessage.group_id == group.id).scalar()
+    if last_id is not None:
+        advance_read_mark(db.connection(), group.id, current_user.id, last_id)
     db.commit()
     return {"status": "success"}
 
-
+@router.get("/group_messages/{group_message_id}/seen_by")
+def get_group_message_seen_by(
+    group_message_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    group_msg = db.query(GroupMessage).filter(GroupMessage.id == group_message_id).first()
+    if not group_msg:
+        raise HTTPException(status_code=404, detail="Group message not found")
+    # Members whose watermark has reached the message
+    readers = db.query(User.username).join(GroupReadMark, GroupReadMark.user_id == User.id).filter(
+        GroupReadMark.group_id == group_msg.group_id,
+        GroupReadMark.last_read_message_id >= group_msg.id,
+        User.id != group_msg.sender_id
+    ).all()
+    return {"message_id": group_msg.id, "seen_by": [username for username, in readers]}
 
 
 @router.post("/messages/send_group")
@@ -313,23 +315,30 @@ async def send_group_message(
         content=content,
         timestamp=datetime.now(WAT)
     )
-    db.add(group_msg)
-    db.commit()
-    db.refresh(group_msg)
+    # Group commit: shares one transaction with other messages sent in the same few ms
+    await ingestor.add(group_msg)
+
+    # Same payload for every member: build it once so it is only encoded once per fan-out
+    group_message_payload = {
+        "type": "group_message",
+        "id": group_msg.id,
+        "from": current_user.username,
+        "group": group.name,
+        "content": content,
+        "file_path": None,
+        "file_type": None,
+        "file_name": None,
+        "timestamp": group_msg.timestamp.astimezone(WAT).isoformat(),
+        "isMe": False,
+        "is_group": True
+    }
+    print("Group message payload:", group_message_payload)
+
+    # Every member's counter in one query; they were bumped in the message's own transaction
+    unread = group_unread_counts(db, group.id)
+    # One fan-out per distinct counter: most members share one, so this is a handful of frames
+    for unread_count, usernames in members_by_unread(group.members, unread).items():
 
-    for member in group.members:
-    # Calculate unread count for this member
-        unread_count = db.query(GroupMessage).filter(
-            GroupMessage.group_id == group.id,
-            GroupMessage.sender_id != member.id
-        ).outerjoin(
-            GroupMessageRead,
-            (GroupMessageRead.group_message_id == GroupMessage.id) &
-            (GroupMessageRead.user_id == member.id)
-        ).filter(
-            (GroupMessageRead.is_read == False) | (GroupMessageRead.id == None)
-        ).count()
-    
         preview = {
             "type": "chat_preview_update",
             "chat_type": "group",
@@ -339,24 +348,9 @@ async def send_group_message(
             "timestamp": group_msg.timestamp.astimezone(WAT).isoformat(),
             "is_group": True
         }
-        await manager.send_personal_message(preview, member.username)
-
-        group_message_payload = {
-            "type": "group_message",
-            "id": group_msg.id,
-            "from": current_user.username,
-            "group": group.name,
-            "content": content,
-            "file_path": None,
-            "file_type": None,
-            "file_name": None,
-            "timestamp": group_msg.timestamp.astimezone(WAT).isoformat(),
-            "isMe": False,
-            "is_group": True
-        }
-        print("Group message payload:", group_message_payload)
-        await manager.send_personal_message(group_message_payload, member.username)
+        await manager.send_to_users(preview, usernames)
 
+    await manager.send_to_users(group_message_payload, [member.username for member in group.members])
 
     return {
         "message": "Group message sent successfully",
@@ -367,6 +361,10 @@ async def send_group_message(
 @router.get("/groups/{group_name}/messages")
 def get_group_messages(
     group_name: str,
+    before_id: int = Query(None),
+    after_id: int = Query(None),
+    limit: int = Query(None, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    stream: bool = Query(False),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
@@ -374,9 +372,17 @@ def get_group_messages(
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
 
-    messages = db.query(GroupMessage).filter(GroupMessage.group_id == group.id).order_by(GroupMessage.timestamp).all()
-
-    def serialize(msg: GroupMessage):
+    # Everything up to the user's watermark is read
+    read_up_to = db.query(GroupReadMark.last_read_message_id).filter(
+        GroupReadMark.group_id == group.id, GroupReadMark.user_id == current_user.id
+    ).scalar() or 0
+    # One statement per page: the sender name comes in through a join instead of a lazy load per message
+    history = db.query(GroupMessage, User.username).outerjoin(
+        User, User.id == GroupMessage.sender_id
+    ).filter(GroupMessage.group_id == group.id)
+
+    def serialize(row):
+        msg, sender_name = row
         forwarded = None
         if msg.forwarded_from_type:
             forwarded = {
@@ -385,23 +391,24 @@ def get_group_messages(
                 "content": msg.forwarded_from_content,
                 "timestamp": msg.forwarded_from_timestamp.astimezone(WAT).isoformat() if msg.forwarded_from_timestamp else None
             }
-        read = db.query(GroupMessageRead).filter_by(
-            group_message_id=msg.id,
-            user_id=current_user.id,
-            is_read=True
-        ).first()
         return {
             "id": msg.id,
-            "from": msg.sender.username if msg.sender else msg.sender_username or "System",
+            "from": sender_name or msg.sender_username or "System",
             "content": msg.content,
             "file_path": msg.file_path,
             "file_type": msg.file_type,
             "sender_username": msg.sender_username,
             "timestamp": msg.timestamp.astimezone(WAT).isoformat(),
-            "is_read": bool(read),
-            "isMe": msg.sender_id == current_user.id if msg.sender else (msg.sender_username == current_user.username),
+            "is_read": msg.id <= read_up_to,
+            "isMe": msg.sender_id == current_user.id if sender_name is not None else (msg.sender_username == current_user.username),
             "forwarded_from": forwarded
         }
+
+    if before_id is not None or after_id is not None or limit is not None:
+        return page_response(*page_history(history, GroupMessage.id, before_id, after_id, limit), serialize)
+    if stream:
+        return stream_history(history, GroupMessage.id, serialize)
+    messages = history.order_by(GroupMessage.timestamp).all()
     return {"messages": [serialize(m) for m in messages]}
 
 
@@ -434,18 +441,15 @@ async def send_file_message(
     db.commit()
     db.refresh(message)
 
-    unread_count = db.query(Message).filter(
-        Message.sender_id == current_user.id,
-        Message.receiver_id == receiver.id,
-        Message.is_read == False
-    ).count()
+    # The receiver's counter for this chat, bumped when the message was committed
+    unread = unread_count(db, receiver.id, DIRECT, current_user.id)
 
     preview = {
         "type": "chat_preview_update",
         "chat_type": "direct",
         "chat_id": receiver.username, 
         "last_message": f"[File] {file.filename}",
-        "unread_count": unread_count,
+        "unread_count": unread,
         "timestamp": message.timestamp.astimezone(WAT).isoformat(),
         "is_group": False,
         "file_name": file.filename,
@@ -466,10 +470,8 @@ async def send_file_message(
         "file_name": file.filename
     }
     print(f"Sending file message via WebSocket to {to_username}: {formatted}")
-    await manager.send_personal_message(formatted, to_username)
-    await manager.send_personal_message(formatted, current_user.username)
-    await manager.send_personal_message(preview, to_username)
-    await manager.send_personal_message(preview, current_user.username)
+    await manager.send_to_users(formatted, [to_username, current_user.username])
+    await manager.send_to_users(preview, [to_username, current_user.username])
     
     return {
         "message": "File sent successfully",
@@ -524,17 +526,8 @@ async def send_group_file_message(
         "isMe": False,
         "is_group": True
     }
-    for member in group.members:
-        unread_count = db.query(GroupMessage).filter(
-            GroupMessage.group_id == group.id,
-            GroupMessage.sender_id != member.id
-        ).outerjoin(
-            GroupMessageRead,
-            (GroupMessageRead.group_message_id == GroupMessage.id) &
-            (GroupMessageRead.user_id == member.id)
-        ).filter(
-            (GroupMessageRead.is_read == False) | (GroupMessageRead.id == None)
-        ).count()
+    unread = group_unread_counts(db, group.id)
+    for unread_count, usernames in members_by_unread(group.members, unread).items():
 
         preview = {
             "type": "chat_preview_update",
@@ -547,9 +540,9 @@ async def send_group_file_message(
             "file_name": file.filename
         }
         print(preview)
-        print(formatted)
-        await manager.send_personal_message(preview, member.username)
-        await manager.send_personal_message(formatted, member.username)
+        await manager.send_to_users(preview, usernames)
+    print(formatted)
+    await manager.send_to_users(formatted, [member.username for member in group.members])
     
     return {
         "message": "Group file sent successfully",
@@ -683,8 +676,7 @@ async def forward_message(
         }
     }
     print(f"[debug] outgoing forward payload: {formatted}")
-    await manager.send_personal_message(formatted, to_username)
-    await manager.send_personal_message(formatted, current_user.username)
+    await manager.send_to_users(formatted, [to_username, current_user.username])
 
     return {"message": "Message forwarded", "id": forwarded.id}
 
@@ -750,8 +742,7 @@ async def forward_group_message(
         }
     }
     print(f"[debug] outgoing group forward payload: {formatted}")
-    for member in group.members:
-        await manager.send_personal_message(formatted, member.username)
-        print("Sending group forward payload:", formatted)
+    print("Sending group forward payload:", formatted)
+    await manager.send_to_users(formatted, [member.username for member in group.members])
 
     return {"message": "Group message forwarded", "id": forwarded.id}
\ No newline at end of file
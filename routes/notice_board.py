@@ -160,16 +160,15 @@ async def create_notice_post(
     db.commit()
     db.refresh(post)
 
-    for follower in board.followers:
-        await manager.send_personal_message({
-            "type": "notice_post",
-            "board": board.name,
-            "title": post.title,
-            "description": post.description,
-            "timestamp": post.timestamp.isoformat(),
-            "attachment_path": post.attachment_path,
-            "posted_by": current_user.username
-        }, follower.username)
+    await manager.send_to_users({
+        "type": "notice_post",
+        "board": board.name,
+        "title": post.title,
+        "description": post.description,
+        "timestamp": post.timestamp.isoformat(),
+        "attachment_path": post.attachment_path,
+        "posted_by": current_user.username
+    }, [follower.username for follower in board.followers])
 
     return {"message": "Post created", "id": post.id, "title": post.title}
     
@@ -1,14 +1,17 @@
-from fastapi import APIRouter, HTTPException, Depends, Form, Body
+from fastapi import APIRouter, HTTPException, Depends, Form, Body, Request
 from sqlalchemy.orm import Session
-from app.database import SessionLocal
+from app.database import SessionLocal, run_in_db_thread
 from app.models import User
-from app.auth import hash_password, verify_password
+from app.auth import hash_password, hash_passwords, verify_and_update_password, verify_password, verify_passwords
 from app.schemas import UserOut, UserProfile, PasswordResetRequest
 from app.authj.jwt_handler import create_access_token
 from app.authj.dependencies import get_current_user
+from app.authj.principal_cache import principal_cache
+from app.authj.sessions import open_session, revoke_session, revoke_user_sessions, rotate_session
 import asyncio
 from app.websocket_manager import manager  # Import WebSocket manager
-from datetime import datetime
+from app.presence import presence_store
+from app.ratelimit import limit_auth_request
 
 router = APIRouter()
 
@@ -22,6 +25,7 @@ def get_db():
 
 @router.post("/signup")
 def signup(
+    request: Request,
     name: str = Form(...),
     job_title: str = Form(None),
     email: str = Form(...),
@@ -33,11 +37,15 @@ def signup(
     security_answer3: str = Form(...),
     db: Session = Depends(get_db)
 ):
+    limit_auth_request(request, username)  # Before any of the four bcrypt hashes
+
     # Check if username/email already exists
     if db.query(User).filter((User.username == username) | (User.email == email)).first():
         raise HTTPException(status_code=400, detail="Username or email already registered")
 
-    hashed_pw = hash_password(password)
+    # The four bcrypt hashes run side by side on the hash pool
+    hashed_pw, answer1, answer2, answer3 = hash_passwords(
+        [password, security_answer1, security_answer2, security_answer3])
     user = User(
         name=name,
         job_title=job_title,
@@ -45,9 +53,9 @@ def signup(
         contact=contact,
         username=username,
         hashed_password=hashed_pw,
-        security_answer1=hash_password(security_answer1),  # hash here
-        security_answer2=hash_password(security_answer2),  # hash here
-        security_answer3=hash_password(security_answer3),  # hash here
+        security_answer1=answer1,
+        security_answer2=answer2,
+        security_answer3=answer3,
     )
     db.add(user)
     db.commit()
@@ -56,48 +64,76 @@ def signup(
 
 @router.post("/login")
 async def login(
+    request: Request,
     username: str = Form(...),
     password: str = Form(...),
     db: Session = Depends(get_db)
 ):
+    limit_auth_request(request, username)
     user = db.query(User).filter(User.username == username).first()
-    if not user or not verify_password(password, user.hashed_password):
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-
-    # Update is_online and last_active_at on login via REST API
-    user.is_online = True
-    user.last_active_at = datetime.utcnow() # Add/Update this line
-    db.commit()
-
+    # bcrypt runs on the hash pool, so a login doesn't stall every socket on this worker
+    valid, new_hash = await verify_and_update_password(password, user.hashed_password)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # Stored with an older cost factor: upgrade it now that we have the plain password
+        # (committed together with the new session)
+        user.hashed_password = new_hash
+    session_id, refresh_token = await run_in_db_thread(open_session, db, user.id)
+
+    # is_online and last_active_at are updated by broadcast_status through the presence
+    # store, which writes them back to the users table in batches.
     # The broadcast_status via manager here is good for immediate notification
     # if the client connects to WebSocket *after* logging in via REST.
     # The WS connect method will also handle this, so it might be redundant
     # if WS connect happens immediately after login. Keep it for safety.
     asyncio.create_task(manager.broadcast_status(username, "online"))
 
-    token = create_access_token(data={"sub": user.username})
+    token = create_access_token(data={"sub": username, "sid": session_id})
 
     return {"message": "Login successful",
-            "username": user.username,
+            "username": username,
             "access_token": token,
+            "refresh_token": refresh_token,
+            "token_type": "Bearer"
+    }
+
+@router.post("/token/refresh")
+def refresh_access_token(
+    refresh_token: str = Form(...),
+    db: Session = Depends(get_db)
+):
+    # No bcrypt here: reconnecting clients trade their refresh token instead of logging in again.
+    # The refresh token rotates; the old one is dead from now on.
+    rotated = rotate_session(db, refresh_token)
+    if rotated is None:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    session_id, username, new_refresh_token = rotated
+
+    return {"message": "Token refreshed",
+            "username": username,
+            "access_token": create_access_token(data={"sub": username, "sid": session_id}),
+            "refresh_token": new_refresh_token,
             "token_type": "Bearer"
     }
 
 @router.post("/logout")
 async def logout(
     username: str = Form(...),
+    refresh_token: str = Form(None),
     db: Session = Depends(get_db)
 ):
     user = db.query(User).filter(User.username == username).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Update is_online and last_active_at on logout via REST API
-    user.is_online = False
-    user.last_active_at = datetime.utcnow() # Add/Update this line
-    db.commit()
+    # End the session, so its refresh token and access tokens stop working
+    if refresh_token:
+        await run_in_db_thread(revoke_session, db, refresh_token, user.id)
 
-    # Broadcast offline status
+    # Broadcast offline status (also records it in the presence store)
     asyncio.create_task(manager.broadcast_status(username, "offline"))
 
     return {"message": "Logout successful", "username": username}
@@ -114,7 +150,7 @@ def get_profile(username: str, db: Session = Depends(get_db)):
         "email": user.email,
         "contact": user.contact,
         "username": user.username,
-        "is_online": user.is_online  # <-- Add this line
+        "is_online": presence_store.is_online(user.username, default=user.is_online)
     }
 
 @router.put("/profile/{username}")
@@ -144,6 +180,7 @@ def update_profile(
         user.contact = contact
 
     db.commit()
+    principal_cache.invalidate(username)
     db.refresh(user)
 
     return {
@@ -167,7 +204,7 @@ def get_users(current_user: User = Depends(get_current_user), db: Session = Depe
             "email": user.email,
             "contact": user.contact,
             "username": user.username,
-            "is_online": user.is_online  # <-- Add this line
+            "is_online": presence_store.is_online(user.username, default=user.is_online)
         }
         for user in users
     ]
@@ -176,11 +213,13 @@ def get_users(current_user: User = Depends(get_current_user), db: Session = Depe
 
 @router.put("/update-password/{username}")
 def update_password(
+    request: Request,
     username: str,
     current_password: str = Form(...),
     new_password: str = Form(...),
     db: Session = Depends(get_db)
 ):
+    limit_auth_request(request, username)
     user = db.query(User).filter(User.username == username).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -190,12 +229,15 @@ def update_password(
 
     user.hashed_password = hash_password(new_password)
     db.commit()
+    revoke_user_sessions(db, user.id)  # Log out every device
+    principal_cache.invalidate(username)
 
     return {"message": "Password updated successfully"}
 
 
 @router.post("/verify_security_answers")
 def verify_security_answers(
+    request: Request,
     data: dict = Body(...),
     db: Session = Depends(get_db)
 ):
@@ -203,6 +245,7 @@ def verify_security_answers(
     answers = data.get("answers", [])
     if not username or len(answers) != 3:
         raise HTTPException(status_code=400, detail="Invalid data")
+    limit_auth_request(request, username)
 
     user = db.query(User).filter(User.username == username).first()
     if not user:
@@ -210,22 +253,26 @@ def verify_security_answers(
 
     # Assume user.security_answers is a list of hashed answers in order
     # You should hash/check answers as appropriate for your app
-    for i, ans in enumerate(answers):
-        if not verify_password(ans, getattr(user, f"security_answer{i+1}")):
-            raise HTTPException(status_code=403, detail="Incorrect answers")
+    checks = verify_passwords([(ans, getattr(user, f"security_answer{i+1}")) for i, ans in enumerate(answers)])
+    if not all(checks):
+        raise HTTPException(status_code=403, detail="Incorrect answers")
 
     return {"message": "Security answers verified"}
 
 @router.put("/reset-password/{username}")
 def reset_password(
+    request: Request,
     username: str,
     req: PasswordResetRequest,
     db: Session = Depends(get_db)
 ):
+    limit_auth_request(request, username)
     user = db.query(User).filter(User.username == username).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     user.hashed_password = hash_password(req.new_password)
     db.commit()
+    revoke_user_sessions(db, user.id)  # Log out every device
+    principal_cache.invalidate(username)
     return {"message": "Password reset successfully"}
@@ -1,91 +1,125 @@
 # In websocket.py
 
-from fastapi import WebSocket, APIRouter, Depends, WebSocketDisconnect, Query
+from fastapi import WebSocket, APIRouter, Depends, HTTPException, WebSocketDisconnect, Query
 from sqlalchemy.orm import Session
 from app.models import User, Message, Group, GroupMessage # Ensure User is imported for db operations
 from app.websocket_manager import manager # Import your ConnectionManager instance
+from app.presence import presence_store
+from app.ingest import ingestor
+from app.auth import hash_pool
+from app.ratelimit import auth_rate_limit_stats
 from datetime import datetime, timezone, timedelta
-from app.database import get_db
-from app.authj.jwt_handler import verify_jwt_token
+from app.database import get_db, run_in_db_thread
+from app.authj.principal_cache import principal_cache, session_active
+from app.authj.dependencies import get_current_user
 import json
-import asyncio # Import asyncio for the heartbeat task
+import functools
 
 router = APIRouter()
 # manager = ConnectionManager() # This line should remain commented out or removed, as manager is instantiated in websocket_manager.py
 
 # WAT = timezone(timedelta(hours=1)) # Keep your timezone definition if needed for messages
 
+# Blocking DB work for the socket loop. Each helper runs on the DB thread via run_in_db_thread,
+# so commits never stall the event loop (and every other socket with it).
+
+def _releases_connection(fn):
+    """Close the session when fn returns: a socket lives for hours, its pooled connection shouldn't."""
+    @functools.wraps(fn)
+    def wrapper(db: Session, *args):
+        try:
+            return fn(db, *args)
+        finally:
+            db.close()
+    return wrapper
+
+@_releases_connection
+def _load_user(db: Session, username: str, session_id: int = None):
+    # The session is checked in the DB rather than the cache: a socket outlives the cache's TTL,
+    # so a revoked login must not get one
+    if session_id is not None and not session_active(db, session_id):
+        return None
+    # A detached id/username principal, so reading user.id later never refreshes on the loop
+    return principal_cache.load_user(db, username)
+
+@_releases_connection
+def _update_message_status(db: Session, message_id: int, status: str):
+    """Returns the sender's username, or None if the message doesn't exist."""
+    msg = db.query(Message).filter(Message.id == message_id).first()
+    if not msg:
+        return None
+    if status == "seen":
+        msg.is_read = True
+        db.commit()
+    return msg.sender.username if msg.sender else None
+
+@_releases_connection
+def _find_group(db: Session, group_name: str):
+    """Returns (group id, member usernames), or None if there is no such group."""
+    group = db.query(Group).filter(Group.name == group_name).first()
+    if not group:
+        return None
+    return group.id, [member.username for member in group.members]
+
+@_releases_connection
+def _find_user_id(db: Session, username: str):
+    return db.query(User.id).filter(User.username == username).scalar()
+
 @router.websocket("/ws/{username}")
 async def websocket_endpoint(
     websocket: WebSocket,
     username: str,
     token: str = Query(...),
+    device_id: str = Query(None), # Stable per-device id so one user can stay connected on several devices
+    last_seq: int = Query(None), # Last "seq" the client saw; the frames after it are replayed
+    epoch: str = Query(None), # Epoch from the "session" frame that seq belongs to
     db: Session = Depends(get_db) # Inject database session
 ):
+    connection = None
     try:
         # JWT authentication: token must match username
-        payload = verify_jwt_token(token)
+        payload = principal_cache.decode(token)
         if not payload or payload.get("sub") != username:
             print(f"Auth failed - Token sub: {payload.get('sub') if payload else 'None'}, Username: {username}")
             await websocket.close(code=4003)
             return
 
         # Validate user existence in DB
-        user = db.query(User).filter(User.username == username).first()
+        user = await run_in_db_thread(_load_user, db, username, payload.get("sid"))
         if not user:
-            print(f"User not found: {username}")
+            print(f"User not found or session ended: {username}")
             await websocket.close(code=4004)
             return
 
-        # Connect the user via manager, passing the db session
-        await manager.connect(username, websocket, db) # Pass db session here
-
-        # Start a periodic heartbeat message from the server to the client
-        # This is optional but can help maintain the connection and verify client presence.
-        # The client will respond with "pong" frames automatically.
-        # You could also send application-level heartbeats here.
-        async def send_heartbeat():
-            while True:
-                await asyncio.sleep(30) # Send heartbeat every 30 seconds
-                try:
-                    # Send a simple JSON message as a heartbeat. Client can ignore it.
-                    await websocket.send_json({"type": "heartbeat"})
-                except WebSocketDisconnect:
-                    print(f"Heartbeat: WebSocketDisconnect for {username}")
-                    break
-                except Exception as e:
-                    print(f"Heartbeat error for {username}: {e}")
-                    break # Break the loop on other errors
-
-        heartbeat_task = asyncio.create_task(send_heartbeat())
+        # Connect the user via manager
+        # The user row we just loaded is reused, so a reconnect doesn't query it again
+        connection = await manager.connect(user, websocket, device_id, last_seq, epoch)
 
+        # Server heartbeats and idle-timeout eviction are handled by the manager's scheduler
 
         try:
             while True:
                 # Receiving any message implies the client is active,
                 # so the server can implicitly update last_active_at.
                 # If you need an explicit client-side heartbeat, listen for it here.
-                data = await websocket.receive_json()
+                data = await connection.receive() # JSON or MessagePack, whichever was negotiated
                 event_type = data.get("type")
 
                 # If you sent a client-side heartbeat, update last_active_at here:
                 if event_type == "heartbeat":
-                    user.last_active_at = datetime.utcnow()
-                    db.commit()
+                    # Memory only; the presence store writes last_active_at back in batches
+                    presence_store.touch(username)
                     # print(f"Received client heartbeat from {username}. Last active updated.")
                     continue # Don't process as a regular message
 
                 # Handle message status events (your existing logic)
                 if event_type == "message_status":
+                    if not connection.admit("message_status"):
+                        continue
                     message_id = data.get("message_id")
                     status = data.get("status")  # "delivered" or "seen"
                     
-                    msg = db.query(Message).filter(Message.id == message_id).first()
-                    if msg and status == "seen":
-                        msg.is_read = True
-                        db.commit()
-                    
-                    sender_username = msg.sender.username if msg and msg.sender else None
+                    sender_username = await run_in_db_thread(_update_message_status, db, message_id, status)
                     if sender_username:
                         await manager.send_personal_message({
                             "type": "message_status",
@@ -94,19 +128,26 @@ async def websocket_endpoint(
                         }, sender_username)
                     continue
 
+                # Per-connection flow control, before any validation or DB work
+                if not connection.admit("chat"):
+                    continue
+
                 # Validate message content (your existing logic)
                 content = data.get("content")
                 if not content or not isinstance(content, str):
-                    await websocket.send_json({"error": "Invalid message content"})
+                    connection.enqueue({"error": "Invalid message content"})
                     continue
                 if len(content) > 1000:
-                    await websocket.send_json({"error": "Message too long (max 1000 characters)"})
+                    connection.enqueue({"error": "Message too long (max 1000 characters)"})
                     continue
 
                 to_user = data.get("to")
                 group_name = data.get("group")
                 file_path = data.get("file_path")
                 file_type = data.get("file_type")
+                if not all(value is None or isinstance(value, str) for value in (file_path, file_type)):
+                    connection.enqueue({"error": "Invalid file_path or file_type"})
+                    continue
                 # Use UTC for consistency, or ensure WAT is always correctly applied everywhere
                 timestamp = datetime.now(WAT) if 'WAT' in locals() else datetime.utcnow()
 
@@ -114,54 +155,49 @@ async def websocket_endpoint(
                 try:
                     if group_name:
                         # Group message (your existing logic)
-                        group = db.query(Group).filter(Group.name == group_name).first()
-                        if not group:
-                            await websocket.send_json({"error": f"Group '{group_name}' not found"})
+                        found = await run_in_db_thread(_find_group, db, group_name)
+                        if found is None:
+                            connection.enqueue({"error": f"Group '{group_name}' not found"})
                             continue
-                        group_msg = GroupMessage(
-                            group_id=group.id,
+                        group_id, members = found
+                        # Committed together with other messages arriving in the same few ms
+                        await ingestor.add(GroupMessage(
+                            group_id=group_id,
                             sender_id=user.id,
                             sender_username=user.username,
                             content=content,
                             file_path=file_path,
                             file_type=file_type,
                             timestamp=timestamp
-                        )
-                        db.add(group_msg)
-                        db.commit()
+                        ))
                         formatted = {
                             "type": "group_message",
                             "from": username,
-                            "group": group.name,
+                            "group": group_name,
                             "content": content,
                             "file_path": file_path,
                             "file_type": file_type,
                             "timestamp": str(timestamp)
                         }
-                        for member in group.members:
-                            # Send group message to all members, excluding the sender only if desired
-                            await manager.send_personal_message(formatted, member.username)
+                        # Send group message to all members in one fan-out (encoded once)
+                        await manager.send_to_users(formatted, members)
                         continue
 
                     # Direct or broadcast message (your existing logic)
                     receiver_id = None
                     if to_user:
-                        receiver = db.query(User).filter(User.username == to_user).first()
-                        if not receiver:
-                            await websocket.send_json({"error": f"User '{to_user}' not found"})
+                        receiver_id = await run_in_db_thread(_find_user_id, db, to_user)
+                        if receiver_id is None:
+                            connection.enqueue({"error": f"User '{to_user}' not found"})
                             continue
-                        receiver_id = receiver.id
-
-                    message = Message(
+                    await ingestor.add(Message(
                         sender_id=user.id,
                         receiver_id=receiver_id,
                         content=content,
                         file_path=file_path,
                         file_type=file_type,
                         timestamp=timestamp
-                    )
-                    db.add(message)
-                    db.commit()
+                    ))
                     formatted = {
                         "type": "direct_message" if to_user else "broadcast",
                         "from": username,
@@ -171,37 +207,46 @@ async def websocket_endpoint(
                         "file_type": file_type,
                         "timestamp": str(timestamp)
                     }
-                    if to_user and receiver_id:
-                        await manager.send_personal_message(formatted, to_user)
-                        await manager.send_personal_message(formatted, username) # Send to sender as well
+                    if to_user:
+                        await manager.send_to_users(formatted, [to_user, username]) # Send to sender as well
                     else:
                         await manager.broadcast(formatted, exclude=None) # Broadcast to all
                 except Exception as e:
                     print(f"Error processing message: {str(e)}")
-                    await websocket.send_json({"error": "Failed to process message"})
+                    connection.enqueue({"error": "Failed to process message"})
                     continue
         except WebSocketDisconnect:
             # This block handles graceful and ungraceful client disconnections.
             print(f"WebSocketDisconnect for {username}. Calling manager.disconnect.")
-            # Ensure the heartbeat task is cancelled when the WS disconnects
-            heartbeat_task.cancel()
-            # Pass the db session to manager.disconnect
-            await manager.disconnect(username, db)
+            await manager.disconnect(connection)
         except Exception as e:
             # Catch any other unexpected errors in the WebSocket loop
             print(f"Unexpected error in websocket connection for {username}: {str(e)}")
-            heartbeat_task.cancel() # Cancel heartbeat task
             # Ensure disconnect is called even on other errors
-            await manager.disconnect(username, db) # Pass the db session to manager.disconnect
+            await manager.disconnect(connection)
 
     except WebSocketDisconnect:
         # This outer block catches WebSocketDisconnects that happen during initial setup (before while True loop)
         print(f"Outer WebSocketDisconnect for {username}. Calling manager.disconnect.")
-        # No heartbeat_task to cancel yet, as it's not started.
-        await manager.disconnect(username, db) # Pass the db session to manager.disconnect
+        if connection is not None:
+            await manager.disconnect(connection)
     except Exception as e:
         # This outer block catches any other unexpected errors during initial setup
         print(f"Unexpected error during websocket setup for {username}: {str(e)}")
         await websocket.close(code=4000) # Generic error code
         # Don't call manager.disconnect here as the connect might not have completed successfully.
 
+
+@router.get("/ws/stats")
+def websocket_stats(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Lists every connected user and device (and who is being throttled), so admins only.
+    # current_user only carries id and username, hence the query.
+    if not db.query(User.is_admin).filter(User.id == current_user.id).scalar():
+        raise HTTPException(status_code=403, detail="Admin access required")
+    # Outbound queue depth and drop counters for every live connection (one entry per device)
+    stats = manager.get_stats()
+    stats["ingest"] = ingestor.stats()
+    stats["auth"] = principal_cache.stats()
+    stats["hashing"] = hash_pool.stats()
+    stats["auth_rate_limit"] = auth_rate_limit_stats()
+    return stats
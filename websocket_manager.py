@@ -1,99 +1,652 @@
 # In websocket_manager.py
 
 from fastapi import WebSocket
-from typing import Dict, List # Added List for type hinting in broadcast
+from typing import Dict, List, Optional, Union # Added List for type hinting in broadcast
+from collections import OrderedDict, deque
 import json
 from sqlalchemy.orm import Session # Import Session for database operations
 from datetime import datetime # Import datetime for last_active_at
 import asyncio # Import asyncio if you plan more async operations here
+import random
+import time
+import uuid
 
 # Assuming you can import your User model and database session here
 from app.models import User
-from app.database import SessionLocal # Or whatever your session factory is
+from app.database import SessionLocal, run_in_db_thread # Or whatever your session factory is
+from app.backplane import Backplane, create_backplane
+from app.frames import MSGPACK, Frame, as_frame, negotiate, unpackb
+from app.presence import PresenceCoalescer, load_interest, presence_store, INTEREST_CACHE_SECONDS
+from app.ratelimit import TokenBucket
 
 # It's better to pass the DB session as an argument rather than importing SessionLocal directly
 # into manager, as it's typically managed by FastAPI's dependency injection.
 # However, for the background task in main.py, SessionLocal will be needed.
 
+# Outbound queue settings (per connection)
+OUTBOUND_QUEUE_SIZE = 256  # Max frames waiting for a single socket
+SEND_TIMEOUT_SECONDS = 10  # A single send taking longer than this marks the peer as a slow consumer
+# What to do when a connection's queue is full:
+#   "drop_oldest" - drop the oldest non-critical frame (status updates etc.); disconnect only if
+#                   every queued frame is critical
+#   "disconnect"  - close the slow consumer straight away
+OVERFLOW_POLICY = "drop_oldest"
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
+
+# Close code used when a slow consumer is kicked (1008 = policy violation)
+SLOW_CONSUMER_CLOSE_CODE = 1008
+
+# Heartbeats and dead-peer detection, run by one scheduler per manager (not one task per socket).
+# Connections are spread over HEARTBEAT_BUCKETS buckets and one bucket is swept per tick, so each
+# socket gets a heartbeat about every HEARTBEAT_INTERVAL_SECONDS without them all firing at once.
+HEARTBEAT_INTERVAL_SECONDS = 30
+HEARTBEAT_BUCKETS = 30
+# A peer that hasn't sent anything (messages, heartbeats) for this long is assumed dead and closed.
+# Clients answer the server's heartbeat with their own, so live clients never hit it. None disables.
+IDLE_TIMEOUT_SECONDS = 90
+IDLE_CLOSE_CODE = 1001  # Going away
+
+# Replay on reconnect: the last OUTBOX_SIZE sequenced frames are kept per user, for at most
+# OUTBOX_MAX_USERS users (least recently messaged are dropped first). A client that was away
+# longer than that gets a "resync" frame and reloads history instead.
+OUTBOX_SIZE = 256
+OUTBOX_MAX_USERS = 10000
+# Queue slots a replay leaves free for live frames arriving meanwhile. A replay that wouldn't fit
+# in the outbound queue with this much room to spare is answered with "resync" instead; queueing it
+# would evict the client, which would then reconnect with the same last_seq forever.
+REPLAY_QUEUE_HEADROOM = 32
+
+# Inbound flow control (per connection): frame kind -> (frames per second, burst). "chat" covers
+# direct, group and broadcast messages. A frame over the limit is dropped and answered with a
+# "rate_limited" error frame; a client that keeps going (INBOUND_STRIKE_LIMIT dropped frames within
+# INBOUND_STRIKE_WINDOW_SECONDS) is disconnected. Heartbeats are never limited.
+INBOUND_LIMITS = {
+    "chat": (5, 20),
+    "message_status": (20, 100),
+}
+INBOUND_STRIKE_LIMIT = 50
+INBOUND_STRIKE_WINDOW_SECONDS = 10
+RATE_LIMIT_CLOSE_CODE = 1008  # Policy violation
+THROTTLED_USERS_TRACKED = 100  # Most recently throttled users kept for get_stats()
+
+
+class Connection:
+    """
+    A single accepted WebSocket with its own bounded outbound queue.
+    Senders only enqueue; a dedicated writer task drains the queue, so one slow
+    client never holds up delivery to anybody else.
+    """
+
+    def __init__(self, username: str, websocket: WebSocket, manager: "ConnectionManager",
+                 max_queue: int = OUTBOUND_QUEUE_SIZE, overflow_policy: str = OVERFLOW_POLICY,
+                 device_id: str = None, protocol: str = None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.username = username
+        self.device_id = device_id
+        self.protocol = protocol  # Accepted subprotocol; None means plain JSON
+        self.websocket = websocket
+        self.manager = manager
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.queue = deque()  # Items are (Frame, critical) tuples
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self.last_seen = time.monotonic()  # Last inbound frame, for the idle timeout
+        self.bucket = random.randrange(HEARTBEAT_BUCKETS)
+        # Inbound flow control
+        self.limits = {kind: TokenBucket(rate, burst) for kind, (rate, burst) in manager.inbound_limits.items()}
+        self.throttled = 0
+        self._strikes = 0
+        self._strike_window_start = 0.0
+        self._wakeup = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer_task = asyncio.create_task(self._writer())
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    def enqueue(self, message: Union[Dict, Frame], critical: bool = True) -> bool:
+        """Queue a frame for this socket. Returns False if it was dropped."""
+        if self.closed:
+            return False
+        if len(self.queue) >= self.max_queue:
+            if self.overflow_policy == "drop_oldest" and self._drop_oldest_non_critical():
+                pass  # Made room, fall through and queue the new frame
+            elif self.overflow_policy == "drop_oldest" and not critical:
+                # Queue is all critical frames, the new one is expendable
+                self.dropped += 1
+                self.manager.dropped_frames += 1
+                return False
+            else:
+                self.manager.schedule_evict(self, reason="outbound queue full")
+                return False
+        self.queue.append((as_frame(message), critical))
+        self._wakeup.set()
+        return True
+
+    def admit(self, kind: str) -> bool:
+        """
+        Take a token for an inbound frame of this kind. False means the frame is over the limit and
+        must be dropped; the client has been told, or is being disconnected for persisting.
+        """
+        if self.closed:
+            return False  # Being evicted; frames still in flight are dropped
+        bucket = self.limits.get(kind)
+        if bucket is None:
+            return True
+        wait = bucket.take()
+        if not wait:
+            return True
+        now = time.monotonic()
+        if now - self._strike_window_start > INBOUND_STRIKE_WINDOW_SECONDS:
+            self._strike_window_start = now
+            self._strikes = 0
+        self._strikes += 1
+        self.throttled += 1
+        self.manager.record_throttled(self.username)
+        if self._strikes >= INBOUND_STRIKE_LIMIT:
+            self.manager.rate_limit_evictions += 1
+            self.manager.schedule_evict(self, reason=f"inbound {kind} rate limit", code=RATE_LIMIT_CLOSE_CODE)
+        else:
+            # Expendable: a flooding client must not fill its own queue with critical frames
+            self.enqueue({"type": "rate_limited", "error": "Too many messages, slow down", "kind": kind,
+                          "retry_after": round(wait, 2)}, critical=False)
+        return False
+
+    def _drop_oldest_non_critical(self) -> bool:
+        for index, (_, critical) in enumerate(self.queue):
+            if not critical:
+                del self.queue[index]
+                self.dropped += 1
+                self.manager.dropped_frames += 1
+                return True
+        return False
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                frame, _ = self.queue.popleft()
+                # The frame is already (or now, once for everyone) encoded; just ship it
+                if self.protocol == MSGPACK:
+                    send = self.websocket.send_bytes(frame.packed)
+                else:
+                    send = self.websocket.send_text(frame.text)
+                try:
+                    await asyncio.wait_for(send, SEND_TIMEOUT_SECONDS)
+                except asyncio.TimeoutError:
+                    self.manager.schedule_evict(self, reason="send timed out")
+                    return
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Socket is gone; the endpoint's receive loop will notice and clean up.
+            print(f"Writer for {self.username} stopped: {e}")
+            self.closed = True
+
+    async def receive(self) -> Dict:
+        """Next frame from the client, decoded according to the negotiated protocol."""
+        if self.protocol == MSGPACK:
+            data = unpackb(await self.websocket.receive_bytes())
+        else:
+            data = await self.websocket.receive_json()
+        self.last_seen = time.monotonic()
+        return data
+
+    async def close(self, code: int = 1000):
+        """Stop the writer and close the socket. Safe to call more than once."""
+        if self.closed and self._writer_task is None:
+            return
+        self.closed = True
+        self.queue.clear()
+        if self._writer_task is not None and self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()
+        self._writer_task = None
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), SEND_TIMEOUT_SECONDS)
+        except Exception:
+            pass  # Already closed or the peer is unreachable
+
+    def stats(self) -> Dict:
+        return {
+            "username": self.username,
+            "device_id": self.device_id,
+            "protocol": self.protocol or "json",
+            "queue_depth": self.depth,
+            "idle_seconds": round(time.monotonic() - self.last_seen, 1),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "throttled": self.throttled,
+        }
+
+
+class UserOutbox:
+    """Recent sequenced frames for one user. Everything with seq <= floor is gone."""
+
+    __slots__ = ("frames", "floor")
+
+    def __init__(self, floor: int, size: int = OUTBOX_SIZE):
+        self.frames = deque(maxlen=size)
+        self.floor = floor
+
+    def append(self, frame: Frame):
+        if len(self.frames) == self.frames.maxlen:
+            self.floor = self.frames[0].seq
+        self.frames.append(frame)
+
+    def since(self, last_seq: int) -> Optional[List[Frame]]:
+        """Frames after last_seq, or None if some of them were already dropped."""
+        if last_seq < self.floor:
+            return None
+        return [frame for frame in self.frames if frame.seq > last_seq]
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-
-    # Modified connect to accept db session
-    async def connect(self, username: str, websocket: WebSocket, db: Session):
-        await websocket.accept()
-        self.active_connections[username] = websocket
-        
-        # Update user status in the database on connect
-        user = db.query(User).filter(User.username == username).first()
-        if user:
-            user.is_online = True
-            user.last_active_at = datetime.utcnow() # Set last active timestamp in UTC
-            db.commit()
-            print(f"User {username} connected. Status updated to online.")
-            # Broadcast the online status to other users
-            await self.broadcast_status(username, "online", exclude=username) # Exclude self from broadcast
+    """
+    Owns the sockets held by this worker process. Deliveries, broadcasts and presence
+    changes are published through the backplane, and every manager (one per worker)
+    writes the events it receives to its own sockets.
+    """
+
+    def __init__(self, max_queue: int = OUTBOUND_QUEUE_SIZE, overflow_policy: str = OVERFLOW_POLICY,
+                 backplane: Backplane = None, inbound_limits: Dict[str, tuple] = None):
+        # username -> {device_id: Connection}; one user may be logged in on several devices
+        self.active_connections: Dict[str, Dict[str, Connection]] = {}
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.inbound_limits = INBOUND_LIMITS if inbound_limits is None else inbound_limits
+        self.worker_id = uuid.uuid4().hex
+        self.backplane = backplane or create_backplane(worker_id=self.worker_id)
+        if self.backplane.handler is None:
+            self.backplane.handler = self._handle_event
+        # Presence across all workers: username -> {worker_id: number of connected devices}
+        self.presence_devices: Dict[str, Dict[str, int]] = {}
+        # Counters reported by get_stats()
+        self.dropped_frames = 0
+        self.evicted_connections = 0
+        self.heartbeats_sent = 0
+        self.idle_evictions = 0
+        self.throttled_frames = 0
+        self.rate_limit_evictions = 0
+        self.throttled_users: "OrderedDict[str, int]" = OrderedDict()  # username -> frames dropped
+        # Heartbeat scheduler: bucket index -> connections swept together
+        self._buckets: List[set] = [set() for _ in range(HEARTBEAT_BUCKETS)]
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        # Presence goes only to interested users, batched into presence_diff frames
+        self.presence = PresenceCoalescer(self._presence_watchers, self._send_presence_diff)
+        self._interest_cache: Dict[str, tuple] = {}  # username -> (expires_at, watchers)
+        # Sequenced delivery. Every worker records every user's frames (not only its own
+        # sockets'), so a client can resume on whichever worker it reconnects to.
+        self.epoch: Optional[str] = None  # Set by the backplane's welcome event
+        self.seqs: Dict[str, int] = {}  # username -> last seq handed out
+        self.outboxes: "OrderedDict[str, UserOutbox]" = OrderedDict()
+        self.replays = 0
+        self.replayed_frames = 0
+        self.resyncs = 0
+
+    async def start(self):
+        await self.backplane.start(self._handle_event)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+        await self.presence.stop()
+        await self.backplane.stop()
+
+    async def _heartbeat_loop(self):
+        tick = HEARTBEAT_INTERVAL_SECONDS / HEARTBEAT_BUCKETS
+        index = 0
+        while True:
+            # A little jitter so workers started together don't tick in lockstep
+            await asyncio.sleep(tick * random.uniform(0.9, 1.1))
+            try:
+                self._sweep_bucket(index)
+            except Exception as e:
+                print(f"Error in heartbeat sweep: {e}")
+            index = (index + 1) % HEARTBEAT_BUCKETS
+
+    def _sweep_bucket(self, index: int):
+        """Heartbeat every connection in one bucket and close the ones that went quiet."""
+        now = time.monotonic()
+        for connection in list(self._buckets[index]):
+            if connection.closed:
+                self._buckets[index].discard(connection)
+            elif IDLE_TIMEOUT_SECONDS is not None and now - connection.last_seen > IDLE_TIMEOUT_SECONDS:
+                self.idle_evictions += 1
+                self.schedule_evict(connection, reason=f"no traffic for {now - connection.last_seen:.0f}s",
+                                    code=IDLE_CLOSE_CODE)
+            # Heartbeats are expendable, so they may be dropped if the queue is backed up
+            elif connection.enqueue({"type": "heartbeat"}, critical=False):
+                self.heartbeats_sent += 1
+
+    def is_connected(self, username: str) -> bool:
+        """True if the user has a socket on this worker."""
+        return bool(self.active_connections.get(username))
+
+    def is_online(self, username: str) -> bool:
+        """True if the user has a socket on any worker."""
+        return bool(self.presence_devices.get(username))
+
+    def connections_for(self, username: str) -> List[Connection]:
+        return list(self.active_connections.get(username, {}).values())
+
+    async def connect(self, user: User, websocket: WebSocket, device_id: str = None,
+                      last_seq: int = None, epoch: str = None):
+        """
+        Register a new socket for one of the user's devices.
+        Presence changes only when the user goes from zero devices to one (on any worker),
+        and never touches the DB directly; a device reconnecting with the same device_id
+        simply replaces its old socket.
+        A client passing the last_seq (and epoch) it saw gets only the frames it missed.
+        Clients offering the "msgpack" subprotocol get binary MessagePack frames, others JSON.
+        """
+        username = user.username
+        device_id = device_id or uuid.uuid4().hex
+        protocol = negotiate(websocket.scope.get("subprotocols") or [])
+        await websocket.accept(subprotocol=protocol)
+        devices = self.active_connections.setdefault(username, {})
+        previous = devices.get(device_id)
+        connection = Connection(username, websocket, self, self.max_queue, self.overflow_policy, device_id,
+                                protocol)
+        connection.start()
+        devices[device_id] = connection
+        self._buckets[connection.bucket].add(connection)
+        # No await between registering and queueing the replay, so live frames land after it
+        self._resume(connection, last_seq, epoch)
+        if previous is not None:
+            self._buckets[previous.bucket].discard(previous)
+            asyncio.create_task(previous.close())
         else:
-            print(f"Warning: User {username} not found in DB on WebSocket connect.")
+            print(f"User {username} connected device {device_id} ({len(devices)} devices on this worker).")
+            await self._publish_presence(username)
+        return connection
 
+    def _resume(self, connection: Connection, last_seq: Optional[int], epoch: Optional[str]):
+        """
+        Start the socket with a "session" frame carrying the current seq, followed by any
+        frames after last_seq. If they can't all be replayed the client gets "resync" instead
+        and should reload history over REST, then carry on from the seq in that frame.
+        """
+        username = connection.username
+        current = self.seqs.get(username, 0)
+        replay: Optional[List[Frame]] = []
+        if last_seq is not None:
+            outbox = self.outboxes.get(username)
+            if epoch != self.epoch or last_seq > current:
+                replay = None  # Numbers from another epoch (restart, broker failover)
+            elif last_seq < current:
+                replay = outbox.since(last_seq) if outbox is not None else None
+        # The "session" frame goes first
+        if replay is not None and len(replay) + 1 > connection.max_queue - REPLAY_QUEUE_HEADROOM:
+            replay = None
+        if replay is None:
+            self.resyncs += 1
+            connection.enqueue({"type": "resync", "epoch": self.epoch, "seq": current})
+            return
+        connection.enqueue({"type": "session", "epoch": self.epoch, "seq": current, "replayed": len(replay)})
+        if replay:
+            self.replays += 1
+            self.replayed_frames += len(replay)
+            for frame in replay:
+                connection.enqueue(frame)
+
+    def _record(self, username: str, frame: Frame):
+        self.seqs[username] = frame.seq
+        outbox = self.outboxes.get(username)
+        if outbox is None:
+            outbox = self.outboxes[username] = UserOutbox(floor=frame.seq - 1)
+            if len(self.outboxes) > OUTBOX_MAX_USERS:
+                self.outboxes.popitem(last=False)
+        else:
+            self.outboxes.move_to_end(username)
+        outbox.append(frame)
+
+    def _welcome(self, epoch: str, seqs: Dict[str, int]):
+        """(Re)joined the backplane: adopt its counters and drop outboxes that now have gaps."""
+        if epoch != self.epoch:
+            self.outboxes.clear()
+        else:
+            # Same counters, but we may have missed events while reconnecting
+            for username, seq in seqs.items():
+                if seq != self.seqs.get(username, 0):
+                    self.outboxes.pop(username, None)
+        self.epoch = epoch
+        self.seqs = dict(seqs)
+
+    async def disconnect(self, connection: Connection):
+        """Drop one device. The user only goes offline once their last device is gone."""
+        username = connection.username
+        self._buckets[connection.bucket].discard(connection)
+        devices = self.active_connections.get(username, {})
+        if devices.get(connection.device_id) is not connection:
+            # Already removed, or a newer socket replaced this device; nothing else to do
+            await connection.close()
+            return
 
-    # Modified disconnect to accept db session and be async
-    async def disconnect(self, username: str, db: Session):
         # Remove connection from active_connections
-        if username in self.active_connections:
+        del devices[connection.device_id]
+        await connection.close()
+        print(f"User {username} device {connection.device_id} removed from active connections.")
+        if not devices:
             del self.active_connections[username]
-            print(f"User {username} removed from active connections.")
-
-        # Update user status in the database on disconnect
-        user = db.query(User).filter(User.username == username).first()
-        if user:
-            user.is_online = False
-            user.last_active_at = datetime.utcnow() # Update last active timestamp
-            db.commit()
-            print(f"User {username} disconnected. Status updated to offline.")
-            # Broadcast the offline status to other users
-            await self.broadcast_status(username, "offline", exclude=username) # Exclude self from broadcast
+        await self._publish_presence(username)
+
+    async def _publish_presence(self, username: str):
+        await self.backplane.publish({
+            "op": "presence",
+            "user": username,
+            "worker": self.worker_id,
+            "devices": len(self.active_connections.get(username, {})),
+        })
+
+    async def _handle_event(self, event: Dict):
+        """Apply one backplane event to the sockets held by this worker."""
+        op = event.get("op")
+        if op == "deliver":
+            # One Frame for every recipient on this worker, so the payload is encoded once;
+            # sequenced copies only splice their seq into that encoding
+            frame = Frame(event["message"])
+            critical = event.get("critical", True)
+            seqs = event.get("seqs")
+            for index, username in enumerate(event["users"]):
+                if seqs:
+                    user_frame = frame.sequenced(seqs[index])
+                    self._record(username, user_frame)
+                    self._deliver_local(user_frame, username, critical)
+                else:
+                    self._deliver_local(frame, username, critical)
+        elif op == "welcome":
+            self._welcome(event["epoch"], event["seqs"])
+        elif op == "broadcast":
+            self._broadcast_local(Frame(event["message"]), event.get("exclude"), event.get("critical", True))
+        elif op == "status":
+            # Explicit status changes (REST login/logout, inactivity sweep)
+            persist = event.get("persist", True) and event.get("worker") == self.worker_id
+            for username, status in event["changes"]:
+                presence_store.set_online(username, status == "online", persist=persist)
+                self.presence.update(username, status)
+        elif op == "presence":
+            # The worker that owns the device writes the change back; everyone notifies their sockets
+            self._apply_presence(event["user"], event["worker"], event["devices"],
+                                 persist=event["worker"] == self.worker_id)
+        elif op == "worker_up" and event["worker"] != self.worker_id:
+            # A new worker knows nothing yet; tell it who is connected here
+            for username in list(self.active_connections):
+                await self._publish_presence(username)
+        elif op == "worker_down":
+            # The dead worker can't write back its users going offline; the broker host does it
+            persist = getattr(self.backplane, "is_broker", False)
+            for username, workers in list(self.presence_devices.items()):
+                if event["worker"] in workers:
+                    self._apply_presence(username, event["worker"], 0, persist=persist)
+
+    def _apply_presence(self, username: str, worker: str, devices: int, persist: bool):
+        workers = self.presence_devices.setdefault(username, {})
+        was_online = bool(workers)
+        if devices:
+            workers[worker] = devices
         else:
-            print(f"Warning: User {username} not found in DB on WebSocket disconnect.")
+            workers.pop(worker, None)
+        if not workers:
+            del self.presence_devices[username]
+        now_online = bool(workers)
+        if was_online == now_online:
+            return
+        status = "online" if now_online else "offline"
+        # In-memory only; the presence store writes it back to the users table in batches
+        presence_store.set_online(username, now_online, persist=persist)
+        # Every worker sees the transition and tells its own interested sockets
+        self.presence.update(username, status)
 
-    async def send_personal_message(self, message: Dict, username: str): # Expect message as Dict now
-        try:
-            if username in self.active_connections:
-                await self.active_connections[username].send_json(message)
-                # print(f"Active connections: {list(self.active_connections.keys())}") # Keep if useful for debugging
-                # print(f"Sending to: {username}") # Keep if useful for debugging
+    async def _presence_watchers(self, usernames: List[str]) -> Dict[str, set]:
+        """Locally connected users who share a conversation or group with each subject."""
+        now = asyncio.get_running_loop().time()
+        watchers = {}
+        missing = []
+        for username in usernames:
+            cached = self._interest_cache.get(username)
+            if cached and cached[0] > now:
+                watchers[username] = cached[1]
             else:
-                print(f"User {username} not in active connections for personal message.")
-        except Exception as e:
-            print(f"Error sending personal message to {username}: {str(e)}")
-            # Consider handling stale connection more robustly,
-            # but WebSocketDisconnect in the endpoint should handle most cases.
-            # No automatic disconnect here, let the endpoint handle WebSocketDisconnect
-            # self.disconnect(username) # Don't call disconnect here as it expects db session
+                missing.append(username)
+        if missing:
+            # One query for the whole batch, off the event loop
+            loaded = await run_in_db_thread(self._load_interest, missing)
+            for username, peers in loaded.items():
+                self._interest_cache[username] = (now + INTEREST_CACHE_SECONDS, peers)
+                watchers[username] = peers
+        return {username: {w for w in peers if self.is_connected(w)} for username, peers in watchers.items()}
+
+    def _load_interest(self, usernames: List[str]) -> Dict[str, set]:
+        db = SessionLocal()
+        try:
+            return load_interest(db, usernames)
+        finally:
+            db.close()
+
+    def _send_presence_diff(self, username: str, diff: Dict):
+        # Presence is superseded by the next diff, so it may be dropped under pressure
+        self._deliver_local(Frame(diff), username, critical=False)
+
+    def schedule_evict(self, connection: Connection, reason: str, code: int = SLOW_CONSUMER_CLOSE_CODE):
+        """Kick a slow consumer or dead peer. Its endpoint sees the close and runs the normal disconnect."""
+        if connection.closed:
+            return
+        connection.closed = True
+        self.evicted_connections += 1
+        print(f"Evicting connection of {connection.username}: {reason}")
+        asyncio.create_task(connection.close(code=code))
+
+    def record_throttled(self, username: str):
+        self.throttled_frames += 1
+        self.throttled_users[username] = self.throttled_users.get(username, 0) + 1
+        self.throttled_users.move_to_end(username)
+        if len(self.throttled_users) > THROTTLED_USERS_TRACKED:
+            self.throttled_users.popitem(last=False)
+
+    async def send_personal_message(self, message: Union[Dict, Frame], username: str, critical: bool = True): # Expect message as Dict now
+        await self.send_to_users(message, [username], critical)
+
+    async def send_to_users(self, message: Union[Dict, Frame], usernames: List[str], critical: bool = True):
+        """
+        Fan one payload out to many users (e.g. every group member) as a single event.
+        Publish and return; whichever worker holds each user's sockets enqueues the frame.
+        """
+        if isinstance(message, Frame):
+            message = message.payload
+        usernames = list(dict.fromkeys(usernames))  # De-duplicate, keep order
+        if not usernames:
+            return
+        await self.backplane.publish({"op": "deliver", "users": usernames, "message": message, "critical": critical})
 
-    async def broadcast(self, message: Dict, exclude: str = None): # Expect message as Dict now
+    async def broadcast(self, message: Union[Dict, Frame], exclude: str = None, critical: bool = True): # Expect message as Dict now
+        if isinstance(message, Frame):
+            message = message.payload
+        await self.backplane.publish({"op": "broadcast", "message": message, "exclude": exclude, "critical": critical})
+
+    async def broadcast_status(self, username: str, status: str, exclude: str = None):
+        """
+        Announce a status change. It reaches only users who share a chat or group with
+        `username`, batched with other changes; `exclude` is kept for older callers (the
+        subject is never one of its own watchers).
+        """
+        await self.broadcast_statuses([(username, status)])
+
+    async def broadcast_statuses(self, changes: List[tuple], persist: bool = True):
+        """
+        Announce many (username, status) changes as one event; they reach watchers as one
+        presence_diff each. persist=False when the caller has already written them to the DB.
+        """
+        if not changes:
+            return
+        await self.backplane.publish({"op": "status", "changes": [list(change) for change in changes],
+                                      "worker": self.worker_id, "persist": persist})
+
+    def _deliver_local(self, message: Union[Dict, Frame], username: str, critical: bool):
+        # Enqueue on every local device; each connection's writer task does the actual send
+        frame = as_frame(message)
+        for connection in self.connections_for(username):
+            connection.enqueue(frame, critical)
+
+    def _broadcast_local(self, message: Union[Dict, Frame], exclude: str = None, critical: bool = True):
         # Create a list from active_connections.items() to avoid RuntimeError during iteration
         # if a connection disconnects while iterating
-        for user_name, connection in list(self.active_connections.items()):
+        frame = as_frame(message)
+        for user_name, devices in list(self.active_connections.items()):
             if user_name != exclude:
-                try:
-                    await connection.send_json(message)
-                except RuntimeError as e: # Catch errors if connection is already closed/stale
-                    print(f"Error broadcasting to {user_name}: {e}. Connection might be stale.")
-                    # If you need to remove stale connections here, you'd need db session
-                    # and call await self.disconnect(user_name, db)
-                except Exception as e:
-                    print(f"Error broadcasting to {user_name}: {e}")
-
-    # Modified broadcast_status to accept exclude parameter
-    async def broadcast_status(self, username: str, status: str, exclude: str = None):
-        status_message = {
-            "type": "status",
-            "username": username,
-            "status": status
+                for connection in list(devices.values()):
+                    connection.enqueue(frame, critical)
+
+    def get_stats(self) -> Dict:
+        connections = [c for devices in self.active_connections.values() for c in devices.values()]
+        depths = [c.depth for c in connections]
+        return {
+            "worker_id": self.worker_id,
+            "backplane": self.backplane.stats(),
+            "online_users": len(self.presence_devices),
+            "users": len(self.active_connections),
+            "connections": len(connections),
+            "msgpack_connections": sum(1 for c in connections if c.protocol == MSGPACK),
+            "overflow_policy": self.overflow_policy,
+            "max_queue": self.max_queue,
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "dropped_frames": self.dropped_frames,
+            "frames_encoded": Frame.encodes,
+            "presence": self.presence.stats(),
+            "presence_store": presence_store.stats(),
+            "evicted_connections": self.evicted_connections,
+            "heartbeats_sent": self.heartbeats_sent,
+            "idle_evictions": self.idle_evictions,
+            "inbound_rate_limit": {
+                "limits": {kind: {"rate_per_second": rate, "burst": burst}
+                           for kind, (rate, burst) in self.inbound_limits.items()},
+                "throttled_frames": self.throttled_frames,
+                "evictions": self.rate_limit_evictions,
+                # Most throttled first
+                "throttled_users": dict(sorted(self.throttled_users.items(), key=lambda item: -item[1])),
+            },
+            "sequencing": {
+                "epoch": self.epoch,
+                "outboxes": len(self.outboxes),
+                "outbox_frames": sum(len(outbox.frames) for outbox in self.outboxes.values()),
+                "replays": self.replays,
+                "replayed_frames": self.replayed_frames,
+                "resyncs": self.resyncs,
+            },
+            "per_connection": [c.stats() for c in connections],
         }
-        # Use send_json directly if message is already a dictionary
-        await self.broadcast(status_message, exclude=exclude)
 
 
 manager = ConnectionManager()